@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for fetching and updating sources, reading items, rendering feeds,
+and mass deactivation. Each run generates a data directory of sources that
+fetch synthetic items from bench/stub_source.py, so no network is needed.
+
+Results are written as JSON. Pass a previous result file as --baseline to
+compare against it:
+
+    python bench/bench.py --output baseline.json
+    python bench/bench.py --baseline baseline.json
+"""
+
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, List
+import argparse
+import heapq
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+# Run against this checkout rather than an installed intake
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from intake.app import app
+from intake.cli import cmd_feed
+from intake.source import LocalSource, fetch_items, update_items
+from intake.storage import STORAGE_TYPES
+
+
+STUB_SOURCE = Path(__file__).parent / "stub_source.py"
+
+# Fixed so that the generated items are the same in every run
+BASE_TIME = 1700000000
+
+
+def generate_data(
+    data_path: Path,
+    sources: int,
+    items: int,
+    body_bytes: int,
+    hidden_ratio: float,
+    storage: str,
+) -> List[str]:
+    """
+    Create a data directory of sources that fetch synthetic items, and a
+    channel containing all of them. Returns the source names.
+    """
+    names = [f"source{i:03d}" for i in range(sources)]
+    for name in names:
+        source_path = data_path / name
+        source_path.mkdir(parents=True)
+        config = {
+            "action": {
+                "fetch": {
+                    "exe": sys.executable,
+                    "args": [str(STUB_SOURCE), "fetch"],
+                }
+            },
+            "storage": storage,
+        }
+        (source_path / "intake.json").write_text(json.dumps(config, indent=2))
+        state = {
+            "items": items,
+            "body_bytes": body_bytes,
+            "hidden_ratio": hidden_ratio,
+            "base_time": BASE_TIME,
+        }
+        (source_path / "state").write_text(json.dumps(state))
+    (data_path / "channels.json").write_text(json.dumps({"all": names}))
+    return names
+
+
+class Benchmark:
+    """
+    Collects the timings of repeated runs of each benchmark.
+    """
+
+    def __init__(self):
+        self.runs: Dict[str, List[float]] = {}
+
+    def time(self, name: str, func: Callable) -> None:
+        # The item logging from fetches and updates is part of the cost, but
+        # it is written to /dev/null instead of the terminal
+        with open(os.devnull, "w") as devnull:
+            with redirect_stderr(devnull), redirect_stdout(devnull):
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+        self.runs.setdefault(name, []).append(elapsed)
+        print(f"{name}: {elapsed:.4f}s", file=sys.stderr)
+
+    def results(self) -> dict:
+        return {
+            name: {
+                "runs": runs,
+                "min": min(runs),
+                "median": statistics.median(runs),
+                "mean": statistics.mean(runs),
+            }
+            for name, runs in self.runs.items()
+        }
+
+
+def run_benchmarks(args, bench: Benchmark) -> None:
+    for repeat in range(args.repeat):
+        with TemporaryDirectory(prefix="intake-bench-") as tmp:
+            data_path = Path(tmp)
+            names = generate_data(
+                data_path,
+                args.sources,
+                args.items,
+                args.body_bytes,
+                args.hidden_ratio,
+                args.storage,
+            )
+            sources = [LocalSource(data_path, name) for name in names]
+
+            fetched = {}
+
+            def fetch_all():
+                for source in sources:
+                    fetched[source.source_name] = fetch_items(source)
+
+            def update_all():
+                for source in sources:
+                    update_items(source, fetched[source.source_name])
+
+            bench.time("fetch_items", fetch_all)
+            bench.time("update_items_new", update_all)
+            bench.time("update_items_unchanged", update_all)
+
+            def get_all_items():
+                for name in names:
+                    for _ in LocalSource(data_path, name).get_all_items():
+                        pass
+
+            bench.time("get_all_items", get_all_items)
+
+            def load_channel_items():
+                merged = heapq.merge(
+                    *[
+                        LocalSource(data_path, name).get_sorted_items(False)
+                        for name in names
+                    ],
+                    key=lambda item: item.sort_key,
+                )
+                for item in merged:
+                    item.display_title
+
+            bench.time("load_channel_items", load_channel_items)
+
+            app.config["INTAKE_DATA"] = data_path
+            client = app.test_client()
+
+            def get_page(url: str):
+                # Start each request with a cold item cache
+                app.extensions.pop("intake_item_cache", None)
+                response = client.get(url)
+                assert response.status_code == 200, response.status
+                return response
+
+            bench.time("feed_channel", lambda: get_page("/channel/all"))
+            bench.time("feed_channel_page", lambda: get_page("/channel/all?page=5"))
+            bench.time("feed_source", lambda: get_page(f"/source/{names[0]}"))
+            bench.time("cmd_feed", lambda: cmd_feed(["--data", str(data_path)]))
+
+            # Deactivate a page of visible items. This changes the feed, so it
+            # is done after the other benchmarks.
+            page = [
+                {"source": item.source.source_name, "itemid": item["id"]}
+                for source in sources
+                for item in source.get_sorted_items(show_hidden=False)
+            ][: args.deactivate]
+
+            def mass_deactivate():
+                response = client.post("/mass-deactivate/", json={"items": page})
+                assert response.status_code == 200, response.status
+
+            bench.time("mass_deactivate", mass_deactivate)
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """
+    Print the change in median time of each benchmark from a baseline.
+    """
+    print(f"{'benchmark':<24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in results["results"].items():
+        current = result["median"]
+        if name not in baseline["results"]:
+            print(f"{name:<24} {'-':>10} {current:>10.4f} {'-':>8}")
+            continue
+        base = baseline["results"][name]["median"]
+        change = (current - base) / base * 100 if base else 0.0
+        print(f"{name:<24} {base:>10.4f} {current:>10.4f} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sources", type=int, default=4, help="Number of sources")
+    parser.add_argument(
+        "--items", type=int, default=2000, help="Number of items per source"
+    )
+    parser.add_argument(
+        "--body-bytes", type=int, default=2048, help="Size of each item body"
+    )
+    parser.add_argument(
+        "--hidden-ratio",
+        type=float,
+        default=0.25,
+        help="Fraction of items that are hidden by tts",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=sorted(STORAGE_TYPES),
+        default="files",
+        help="Item storage for the sources",
+    )
+    parser.add_argument(
+        "--deactivate",
+        type=int,
+        default=100,
+        help="Number of items to mass deactivate",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of times to run each benchmark"
+    )
+    parser.add_argument("--output", "-o", help="Write the results to this file")
+    parser.add_argument("--baseline", "-b", help="Compare to the results in this file")
+    args = parser.parse_args()
+
+    bench = Benchmark()
+    run_benchmarks(args, bench)
+
+    results = {
+        "params": {
+            "sources": args.sources,
+            "items": args.items,
+            "body_bytes": args.body_bytes,
+            "hidden_ratio": args.hidden_ratio,
+            "storage": args.storage,
+            "deactivate": args.deactivate,
+            "repeat": args.repeat,
+        },
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": bench.results(),
+    }
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf8"))
+        if baseline["params"] != results["params"]:
+            print("Warning: baseline was run with different params", file=sys.stderr)
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
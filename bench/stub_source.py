@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+"""
+A benchmark source that generates deterministic items from the parameters in
+its state file, so benchmarks can fetch any number of items without network
+access or large state files.
+"""
+
+import argparse, json, os, sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument("action")
+args = parser.parse_args()
+
+if args.action == "fetch":
+    state_path = os.environ.get("STATE_PATH")
+    with open(state_path) as f:
+        state = json.load(f)
+    count = state["items"]
+    body = "x" * state["body_bytes"]
+    hidden_ratio = state["hidden_ratio"]
+    base_time = state["base_time"]
+    for i in range(count):
+        item = {
+            "id": f"item{i:07d}",
+            "title": f"Item {i}",
+            "time": base_time - i * 60,
+            "body": body,
+            "link": f"https://example.com/{i}",
+        }
+        # Hidden items are spread evenly and held back with a far-off tts
+        if int((i + 1) * hidden_ratio) > int(i * hidden_ratio):
+            item["tts"] = 10 * 365 * 86400
+        print(json.dumps(item))
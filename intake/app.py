@@ -1,8 +1,11 @@
 from datetime import datetime, timedelta
 from functools import wraps
+from itertools import islice
 from pathlib import Path
 from random import getrandbits
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
+import hashlib
+import heapq
 import json
 import sys
 import time
@@ -16,15 +19,31 @@ from flask import (
     redirect,
     url_for,
     current_app,
+    g,
+    get_template_attribute,
 )
 
+from intake.cache import ItemCache, DEFAULT_CACHE_BYTES
+from intake.channels import ChannelIndex
+from intake.config import ConfigCache, DEFAULT_MAX_AGE
 from intake.core import intake_data_dir
 from intake.crontab import update_crontab_entries
+from intake.jobs import DEFAULT_JOB_WORKERS, Job, JobQueue
+from intake.metrics import (
+    FEED_DURATION,
+    FEED_ITEMS,
+    METRICS_FILENAME,
+    REGISTRY,
+    read_textfile,
+)
 from intake.source import LocalSource, execute_action, Item
 
 # Globals
 app = Flask(__name__)
 
+# Included in feed ETags so that pages are not reused across server restarts
+ETAG_SALT = getrandbits(32)
+
 
 CRON_HELPTEXT = """cron spec:
 *  *  *  *  *
@@ -74,6 +93,79 @@ def set_query(**kwargs):
     return url_for(request.endpoint, **request.view_args, **args)
 
 
+def get_source(data_path: Path, name: str) -> LocalSource:
+    """
+    Get a source that shares the app's item cache across requests. The source
+    is reused for the rest of the request and closed when the request ends.
+    """
+    sources: Dict[Tuple[Path, str], LocalSource] = g.setdefault("intake_sources", {})
+    if (data_path, name) in sources:
+        return sources[data_path, name]
+    cache = current_app.extensions.get("intake_item_cache")
+    if cache is None:
+        max_bytes = current_app.config.get("INTAKE_CACHE_BYTES", DEFAULT_CACHE_BYTES)
+        cache = current_app.extensions.setdefault(
+            "intake_item_cache", ItemCache(max_bytes)
+        )
+    source = LocalSource(
+        data_path, name, item_cache=cache, config_cache=get_config_cache()
+    )
+    sources[data_path, name] = source
+    return source
+
+
+def get_channel_index(data_path: Path) -> ChannelIndex:
+    """
+    Get the channel index, which is closed when the request ends.
+    """
+    if "intake_channel_index" not in g:
+        g.intake_channel_index = ChannelIndex(data_path)
+    return g.intake_channel_index
+
+
+@app.teardown_request
+def close_indexes(_exception):
+    """
+    Close the index connections opened by the request.
+    """
+    for source in g.pop("intake_sources", {}).values():
+        source.close()
+    channel_index: Optional[ChannelIndex] = g.pop("intake_channel_index", None)
+    if channel_index is not None:
+        channel_index.close()
+
+
+def get_config_cache() -> ConfigCache:
+    """
+    Get the app's config cache, which is shared across requests.
+    """
+    cache = current_app.extensions.get("intake_config_cache")
+    if cache is None:
+        max_age = current_app.config.get("INTAKE_CONFIG_MAX_AGE", DEFAULT_MAX_AGE)
+        cache = current_app.extensions.setdefault(
+            "intake_config_cache", ConfigCache(max_age)
+        )
+    return cache
+
+
+def get_job_queue() -> JobQueue:
+    """
+    Get the app's queue for running item actions in the background.
+    """
+    queue = current_app.extensions.get("intake_jobs")
+    if queue is None:
+        max_workers = current_app.config.get("INTAKE_JOB_WORKERS", DEFAULT_JOB_WORKERS)
+        queue = current_app.extensions.setdefault("intake_jobs", JobQueue(max_workers))
+    return queue
+
+
+def get_channels(data_path: Path) -> Optional[Dict[str, List[str]]]:
+    """
+    Get the channels config, or None if there is none.
+    """
+    return get_config_cache().read_json(data_path / "channels.json")
+
+
 def auth_check(route):
     """
     Checks the HTTP Basic Auth header against the stored credential.
@@ -82,11 +174,10 @@ def auth_check(route):
     @wraps(route)
     def _route(*args, **kwargs):
         data_path: Path = current_app.config["INTAKE_DATA"]
-        auth_path = data_path / "credentials.json"
-        if auth_path.exists():
+        auth = get_config_cache().read_json(data_path / "credentials.json")
+        if auth is not None:
             if not request.authorization:
                 abort(401)
-            auth = json.load(auth_path.open(encoding="utf8"))
             if request.authorization.username != auth["username"]:
                 abort(403)
             if request.authorization.password != auth["secret"]:
@@ -104,16 +195,11 @@ def root():
     """
     data_path: Path = current_app.config["INTAKE_DATA"]
 
-    sources = []
-    for child in data_path.iterdir():
-        if (child / "intake.json").exists():
-            sources.append(LocalSource(data_path, child.name))
-    sources.sort(key=lambda s: s.source_name)
-
-    channels = {}
-    channels_config_path = data_path / "channels.json"
-    if channels_config_path.exists():
-        channels = json.loads(channels_config_path.read_text(encoding="utf8"))
+    sources = [
+        get_source(data_path, name)
+        for name in get_config_cache().list_sources(data_path)
+    ]
+    channels = get_channels(data_path) or {}
 
     return render_template(
         "home.jinja2",
@@ -129,7 +215,7 @@ def source_feed(name):
     Feed view for a single source.
     """
     data_path: Path = current_app.config["INTAKE_DATA"]
-    source = LocalSource(data_path, name)
+    source = get_source(data_path, name)
     if not source.source_path.exists():
         abort(404)
 
@@ -143,36 +229,100 @@ def channel_feed(name):
     Feed view for a channel.
     """
     data_path: Path = current_app.config["INTAKE_DATA"]
-    channels_config_path = data_path / "channels.json"
-    if not channels_config_path.exists():
-        abort(404)
-    channels = json.loads(channels_config_path.read_text(encoding="utf8"))
-    if name not in channels:
+    channels = get_channels(data_path)
+    if channels is None or name not in channels:
         abort(404)
-    sources = [LocalSource(data_path, name) for name in channels[name]]
-
-    return _sources_feed(name, sources, show_hidden=get_show_hidden(False))
+    sources = [get_source(data_path, name) for name in channels[name]]
+    show_hidden = get_show_hidden(False)
+    if show_hidden:
+        return _sources_feed(name, sources, show_hidden)
+
+    # Visible items are read from the channel index, which has the items of
+    # every source already merged in feed order
+    channel_index = get_channel_index(data_path)
+    channel_index.refresh_channels(lambda source: get_source(data_path, source).index)
+    now = time.time()
+
+    def load_page(offset: int, limit: int):
+        paged_items = [
+            get_source(data_path, source).get_item(item_id)
+            for source, item_id in channel_index.sorted_entries(
+                name, now, offset, limit
+            )
+        ]
+        return paged_items, channel_index.count(name, now)
+
+    etag = _feed_etag(channel_index.channel_state(name, now))
+    return _feed_response(etag, lambda: _render_feed(name, load_page, show_hidden))
 
 
 def _sources_feed(name: str, sources: List[LocalSource], show_hidden: bool):
     """
     Feed view for multiple sources.
     """
-    # Get all items
-    all_items = sorted(
-        [
-            item
-            for source in sources
-            for item in source.get_all_items()
-            if not item.is_hidden or show_hidden
-        ],
-        key=item_sort_key,
+    now = time.time()
+    state = [
+        [source.source_name, *source.index.generation(), source.index.next_tts(now)]
+        for source in sources
+    ]
+
+    def load_page(offset: int, limit: int):
+        # Merge the sorted items of each source until the requested page is
+        # filled, using only the indexed fields to filter and sort
+        merged = heapq.merge(
+            *[source.get_sorted_items(show_hidden) for source in sources],
+            key=item_sort_key,
+        )
+        paged_items = [
+            item.source.get_item(item["id"])
+            for item in islice(merged, offset, offset + limit)
+        ]
+        item_count = sum(source.count_items(show_hidden) for source in sources)
+        return paged_items, item_count
+
+    return _feed_response(
+        _feed_etag(state), lambda: _render_feed(name, load_page, show_hidden)
     )
 
-    # Apply paging parameters
+
+def _feed_response(etag: str, render: Callable[[], str]):
+    """
+    Answer with 304 Not Modified before reading any items if the client's copy
+    of the page is still current, otherwise render the page.
+    """
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(render())
+    response.set_etag(etag)
+    # Always revalidate, since the page changes whenever the sources do
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def _feed_etag(state: list) -> str:
+    """
+    Get an ETag for a feed page from the state of its sources. The state should
+    change when any of the feed's sources are written or when a hidden item
+    becomes visible. The ETag also changes when the request parameters change
+    or when the server restarts with possibly different templates.
+    """
+    state = [ETAG_SALT, request.endpoint, request.query_string.decode("utf8"), state]
+    return hashlib.sha1(json.dumps(state).encode("utf8")).hexdigest()
+
+
+def _render_feed(
+    name: str,
+    load_page: Callable[[int, int], Tuple[List[Item], int]],
+    show_hidden: bool,
+):
     count = int(request.args.get("count", "100"))
     page = int(request.args.get("page", "0"))
-    paged_items = all_items[count * page : count * page + count]
+    with FEED_DURATION.time(stage="load"):
+        paged_items, item_count = load_page(count * page, count)
+    FEED_ITEMS.inc(min(item_count, count * page + count), stage="sorted")
+    FEED_ITEMS.inc(len(paged_items), stage="loaded")
+
     pager_prev = (
         None
         if page <= 0
@@ -180,22 +330,54 @@ def _sources_feed(name: str, sources: List[LocalSource], show_hidden: bool):
     )
     pager_next = (
         None
-        if (count * page + count) > len(all_items)
+        if (count * page + count) > item_count
         else url_for(request.endpoint, name=name, count=count, page=page + 1)
     )
 
-    return render_template(
-        "feed.jinja2",
-        items=paged_items,
-        now=int(time.time()),
-        mdeac=[
-            {"source": item.source.source_name, "itemid": item["id"]}
-            for item in paged_items
-            if "id" in item
-        ],
-        page_num=page,
-        page_count=count,
-        item_count=len(all_items),
+    with FEED_DURATION.time(stage="render"):
+        page_html = render_template(
+            "feed.jinja2",
+            items=paged_items,
+            now=int(time.time()),
+            mdeac=[
+                {"source": item.source.source_name, "itemid": item["id"]}
+                for item in paged_items
+                if "id" in item
+            ],
+            page_num=page,
+            page_count=count,
+            item_count=item_count,
+            mdeac_filter=_feed_filter(name, show_hidden),
+        )
+    FEED_ITEMS.inc(len(paged_items), stage="rendered")
+    return page_html
+
+
+def _feed_filter(name: str, show_hidden: bool) -> dict:
+    """
+    Get a mass deactivate filter for the items in the current feed. Items
+    created after the feed was loaded are not included.
+    """
+    kind = "channel" if request.endpoint == "channel_feed" else "source"
+    return {
+        kind: name,
+        "created_before": int(time.time()) + 1,
+        "visible": not show_hidden,
+    }
+
+
+@app.get("/metrics")
+@auth_check
+def metrics():
+    """
+    Metrics for this process and for CLI runs, in the Prometheus text format.
+    """
+    data_path: Path = current_app.config["INTAKE_DATA"]
+    textfile = read_textfile(data_path / METRICS_FILENAME)
+    return (
+        REGISTRY.render(textfile),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
     )
 
 
@@ -203,8 +385,8 @@ def _sources_feed(name: str, sources: List[LocalSource], show_hidden: bool):
 @auth_check
 def deactivate(source_name, item_id):
     data_path: Path = current_app.config["INTAKE_DATA"]
-    source = LocalSource(data_path, source_name)
-    item = source.get_item(item_id)
+    source = get_source(data_path, source_name)
+    item = source.get_item(item_id, body=False)
     if item["active"]:
         print(f"Deactivating {source_name}/{item_id}", file=sys.stderr)
     item["active"] = False
@@ -216,7 +398,7 @@ def deactivate(source_name, item_id):
 @auth_check
 def update(source_name, item_id):
     data_path: Path = current_app.config["INTAKE_DATA"]
-    source = LocalSource(data_path, source_name)
+    source = get_source(data_path, source_name)
     item = source.get_item(item_id)
     params = request.get_json()
     if "tts" in params:
@@ -225,35 +407,181 @@ def update(source_name, item_id):
         til_then = int(morning.timestamp()) - item["created"]
         item["tts"] = til_then
     source.save_item(item)
-    return jsonify(item._item)
+    return jsonify(item.to_dict())
 
 
 @app.post("/mass-deactivate/")
 @auth_check
 def mass_deactivate():
+    """
+    Deactivate many items at once. The items are either listed explicitly as
+    {"items": [{"source": ..., "itemid": ...}, ...]} or selected with
+    {"filter": {...}}, which must have "channel" or "source" and may have:
+
+        tag             Only items with this tag
+        created_before  Only items created before this timestamp
+        time_before     Only items whose time (or created time) is before this
+        visible         If true, only items that are not hidden
+
+    Items are deactivated in one batch per source. Returns the number of items
+    deactivated in each source and in total.
+    """
     data_path: Path = current_app.config["INTAKE_DATA"]
-    params = request.get_json()
-    if "items" not in params:
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict) or ("items" in params) == ("filter" in params):
         print(f"Bad request params: {params}", file=sys.stderr)
-    for info in params.get("items"):
-        source = info["source"]
-        itemid = info["itemid"]
-        source = LocalSource(data_path, source)
-        item = source.get_item(itemid)
-        if item["active"]:
-            print(f"Deactivating {info['source']}/{info['itemid']}", file=sys.stderr)
-        item["active"] = False
-        source.save_item(item)
-    return jsonify({})
+        return jsonify({"error": "Expected either items or filter"}), 400
+
+    # Group the item ids by source
+    item_ids: Dict[str, List[str]] = {}
+    if "items" in params:
+        try:
+            item_ids = _group_item_ids(params["items"])
+        except ValueError as ex:
+            return jsonify({"error": str(ex)}), 400
+        source_names = get_config_cache().list_sources(data_path)
+        sources = [
+            get_source(data_path, name) for name in item_ids if name in source_names
+        ]
+    else:
+        try:
+            sources = _filter_sources(data_path, params["filter"])
+        except ValueError as ex:
+            return jsonify({"error": str(ex)}), 400
+        if sources is None:
+            abort(404)
+
+    counts = {}
+    for source in sources:
+        if "items" in params:
+            ids = item_ids[source.source_name]
+        else:
+            ids = _filter_item_ids(source, params["filter"])
+        counts[source.source_name] = source.deactivate_items(ids)
+        if counts[source.source_name]:
+            print(
+                f"Deactivated {counts[source.source_name]} items in {source}",
+                file=sys.stderr,
+            )
+    return jsonify({"deactivated": sum(counts.values()), "sources": counts})
+
+
+def _group_item_ids(items: list) -> Dict[str, List[str]]:
+    """
+    Group a mass deactivate item list by source.
+    """
+    if not isinstance(items, list):
+        raise ValueError("Items must be a list")
+    item_ids: Dict[str, List[str]] = {}
+    for info in items:
+        if not (
+            isinstance(info, dict)
+            and isinstance(info.get("source"), str)
+            and isinstance(info.get("itemid"), str)
+        ):
+            raise ValueError("Each item must have a source and an itemid")
+        item_ids.setdefault(info["source"], []).append(info["itemid"])
+    return item_ids
+
+
+def _filter_sources(data_path: Path, item_filter: dict) -> Optional[List[LocalSource]]:
+    """
+    Get the sources selected by a mass deactivate filter, or None if the
+    channel or source does not exist.
+    """
+    if not isinstance(item_filter, dict):
+        raise ValueError("Filter must be an object")
+    for key in ("channel", "source", "tag"):
+        if key in item_filter and not isinstance(item_filter[key], str):
+            raise ValueError(f"{key} must be a string")
+    if "channel" in item_filter:
+        channels = get_channels(data_path)
+        if channels is None or item_filter["channel"] not in channels:
+            return None
+        names = channels[item_filter["channel"]]
+    elif "source" in item_filter:
+        if item_filter["source"] not in get_config_cache().list_sources(data_path):
+            return None
+        names = [item_filter["source"]]
+    else:
+        raise ValueError("Filter must have a channel or source")
+    for key in ("created_before", "time_before"):
+        if key in item_filter and not isinstance(item_filter[key], (int, float)):
+            raise ValueError(f"{key} must be a timestamp")
+    return [get_source(data_path, name) for name in names]
+
+
+def _filter_item_ids(source: LocalSource, item_filter: dict) -> List[str]:
+    """
+    Get the ids of the active items in a source that match a filter, using
+    only the indexed fields.
+    """
+    tag = item_filter.get("tag")
+    return [
+        item["id"]
+        for item in source.get_active_items(
+            visible_only=bool(item_filter.get("visible")),
+            created_before=item_filter.get("created_before"),
+            time_before=item_filter.get("time_before"),
+        )
+        if tag is None or tag in item.get("tags", [])
+    ]
 
 
 @app.post("/action/<string:source_name>/<string:item_id>/<string:action>")
 @auth_check
 def action(source_name, item_id, action):
+    """
+    Queue an item action. Returns the action's job, which can be polled at its
+    url until it is done.
+    """
     data_path: Path = current_app.config["INTAKE_DATA"]
-    source = LocalSource(data_path, source_name)
-    item = execute_action(source, item_id, action)
-    return jsonify(item)
+    source = get_source(data_path, source_name)
+    if not source.source_path.exists() or not source.item_exists(item_id):
+        abort(404)
+    item_cache, config_cache = source.item_cache, source.config_cache
+
+    def run_action() -> Item:
+        # The source's index connections cannot be used from another thread,
+        # so the job uses its own source
+        job_source = LocalSource(
+            data_path, source_name, item_cache=item_cache, config_cache=config_cache
+        )
+        try:
+            return execute_action(job_source, item_id, action)
+        finally:
+            job_source.close()
+
+    # Actions on the same item are run one at a time
+    job = get_job_queue().submit((str(data_path), source_name, item_id), run_action)
+    return jsonify(_job_status(job)), 202
+
+
+@app.get("/job/<string:job_id>")
+@auth_check
+def job_status(job_id):
+    """
+    Get the status of an action job, and the updated item when it is done.
+    """
+    job = get_job_queue().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(_job_status(job))
+
+
+def _job_status(job: Job) -> dict:
+    status = {
+        "id": job.id,
+        "status": job.status,
+        "url": url_for("job_status", job_id=job.id),
+    }
+    if job.status == "done":
+        item: Item = job.result
+        status["item"] = item.to_dict()
+        status["html"] = get_template_attribute("item.jinja2", "render_item")(item)
+    elif job.status == "failed":
+        status["error"] = job.error
+    return status
 
 
 @app.route("/edit/source/<string:name>", methods=["GET", "POST"])
@@ -263,7 +591,7 @@ def source_edit(name):
     Config editor for a source
     """
     data_path: Path = current_app.config["INTAKE_DATA"]
-    source = LocalSource(data_path, name)
+    source = get_source(data_path, name)
     if not source.source_path.exists():
         abort(404)
 
@@ -272,6 +600,8 @@ def source_edit(name):
     if request.method == "POST":
         config_str = request.form.get("config", "")
         error_message, config = _parse_source_config(config_str)
+        if not error_message and config.get("storage", "files") != source.storage.name:
+            error_message = "Use intake migrate to change storage"
         if not error_message:
             source.save_config(config)
             update_crontab_entries(data_path)
@@ -313,6 +643,8 @@ def _parse_source_config(config_str: str):
         config["env"] = parsed["env"]
     if "cron" in parsed:
         config["cron"] = parsed["cron"]
+    if "storage" in parsed:
+        config["storage"] = parsed["storage"]
     return (None, config)
 
 
@@ -332,14 +664,12 @@ def channels_edit():
         error_message, config = _parse_channels_config(config_str)
         if not error_message:
             config_path.write_text(json.dumps(config, indent=2), encoding="utf8")
+            get_config_cache().invalidate(config_path)
             return redirect(url_for("root"))
 
     # For GET, load the config
     if request.method == "GET":
-        if config_path.exists():
-            config = json.loads(config_path.read_text(encoding="utf8"))
-        else:
-            config = {}
+        config = get_channels(data_path) or {}
         config_str = json.dumps(config, indent=2)
 
     return render_template(
@@ -381,7 +711,8 @@ def add_item():
         config_path.write_text(
             json.dumps({"action": {"fetch": {"exe": "true"}}}, indent=2)
         )
-    source = LocalSource(source_path.parent, source_path.name)
+        get_config_cache().invalidate(data_path)
+    source = get_source(data_path, source_path.name)
 
     fields = {"id": "{:x}".format(getrandbits(16 * 4))}
     if form_title := request.form.get("title"):
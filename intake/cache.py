@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Hashable, Optional
+
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class ItemCache:
+    """
+    A memory-bounded LRU cache of parsed items that can be shared between
+    LocalSource instances. Each entry is stored with a stamp of the item's
+    file stat, so an entry is only used if the file has not changed since it
+    was read, even if the change was made by another process.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        # The size of an entry is approximated by the size of its item file.
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, stamp: Hashable) -> Optional[dict]:
+        """
+        Get a cached item if it was cached with the same stamp.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != stamp:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, stamp: Hashable, item: dict, size: int) -> None:
+        """
+        Cache an item, evicting the least recently used items if the cache
+        grows too large.
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (stamp, item, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, size = self._entries.pop(key)
+        self.size -= size
@@ -0,0 +1,252 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import json
+import sqlite3
+
+from intake.index import ItemIndex
+
+
+CHANNELS_INDEX_FILENAME = "channels.db"
+
+# The version of the schema below, kept in the index's user_version.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channel_items (
+    source TEXT NOT NULL,
+    id TEXT NOT NULL,
+    created INTEGER NOT NULL,
+    tts INTEGER,
+    sort_time INTEGER NOT NULL,
+    PRIMARY KEY (source, id)
+);
+CREATE INDEX IF NOT EXISTS channel_items_sort ON channel_items (sort_time, id);
+CREATE TABLE IF NOT EXISTS channel_sources (
+    channel TEXT NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (channel, source)
+);
+CREATE TABLE IF NOT EXISTS synced_sources (
+    source TEXT PRIMARY KEY,
+    epoch INTEGER NOT NULL,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+# Matches the channel items that are not hidden. Only active items are kept.
+VISIBLE_CLAUSE = "(tts IS NULL OR created + tts <= ?)"
+
+CHANNEL_SOURCES = "SELECT source FROM channel_sources WHERE channel = ?"
+
+
+class ChannelIndex:
+    """
+    A SQLite file in the data directory with the active items of every source,
+    kept up to date as sources are written, and the sources in each channel.
+    Channel feeds are read from it without reading each source's index.
+
+    Each source's rows are tagged with the generation of the source index they
+    were copied from, so a source whose index changed without the channel
+    index is copied again the next time it is written.
+    """
+
+    def __init__(self, data_path: Path):
+        self.data_path = data_path
+        self.index_path = data_path / CHANNELS_INDEX_FILENAME
+        self._db: Optional[sqlite3.Connection] = None
+        self._batch_depth = 0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(str(self.index_path), timeout=30, isolation_level=None)
+            # As with ItemIndex, only set up a new or outdated index, so opening
+            # it to read doesn't wait for a writer
+            (version,) = db.execute("PRAGMA user_version").fetchone()
+            if version < SCHEMA_VERSION:
+                db.execute("PRAGMA journal_mode = WAL")
+                db.executescript(
+                    f"BEGIN IMMEDIATE; {SCHEMA}"
+                    f" PRAGMA user_version = {SCHEMA_VERSION}; COMMIT;"
+                )
+            self._db = db
+        return self._db
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextmanager
+    def batch(self):
+        """
+        Group writes into a single transaction, like ItemIndex.batch().
+        """
+        if self._batch_depth == 0:
+            self.db.execute("BEGIN IMMEDIATE")
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.db.execute("COMMIT")
+
+    def put(self, source_name: str, item) -> None:
+        """
+        Add or update an item, or remove it if it is inactive.
+        """
+        if not item["active"]:
+            self.remove(source_name, item["id"])
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO channel_items"
+            " (source, id, created, tts, sort_time) VALUES (?, ?, ?, ?, ?)",
+            (
+                source_name,
+                item["id"],
+                item["created"],
+                item.get("tts"),
+                item.get("time") or item["created"],
+            ),
+        )
+
+    def remove(self, source_name: str, item_id: str) -> None:
+        self.db.execute(
+            "DELETE FROM channel_items WHERE source = ? AND id = ?",
+            (source_name, item_id),
+        )
+
+    def clear_source(self, source_name: str) -> None:
+        self.db.execute("DELETE FROM channel_items WHERE source = ?", (source_name,))
+
+    def synced_generation(self, source_name: str) -> Optional[Tuple[int, int]]:
+        row = self.db.execute(
+            "SELECT epoch, generation FROM synced_sources WHERE source = ?",
+            (source_name,),
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def set_synced(self, source_name: str, generation: Tuple[int, int]) -> None:
+        """
+        Record the source index generation that a source's items match.
+        """
+        self.db.execute(
+            "INSERT OR REPLACE INTO synced_sources VALUES (?, ?, ?)",
+            (source_name, *generation),
+        )
+
+    def copy_source(self, source_name: str, index: ItemIndex) -> None:
+        """
+        Replace a source's items with the active items in its index.
+        """
+        with self.batch():
+            self.clear_source(source_name)
+            for entry in index.active_entries():
+                self.put(source_name, entry)
+
+    def sync_source(self, source_name: str, index: ItemIndex) -> None:
+        """
+        Copy a source's active items from its index, unless they already match
+        the index.
+        """
+        generation = index.generation()
+        if self.synced_generation(source_name) == generation:
+            return
+        with self.batch():
+            self.copy_source(source_name, index)
+            self.set_synced(source_name, generation)
+
+    def refresh_channels(self, open_index: Callable[[str], ItemIndex]) -> None:
+        """
+        Update the channel members from channels.json if it changed, and copy
+        the items of any member source that has not been copied yet.
+        """
+        config_path = self.data_path / "channels.json"
+        try:
+            mtime = config_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'channels_mtime'"
+        ).fetchone()
+        if row is not None and row[0] == mtime:
+            return
+
+        channels: Dict[str, List[str]] = {}
+        if mtime is not None:
+            channels = json.loads(config_path.read_text(encoding="utf8"))
+        with self.batch():
+            self.set_channels(channels)
+            for (source_name,) in self.db.execute(
+                "SELECT DISTINCT source FROM channel_sources"
+                " WHERE source NOT IN (SELECT source FROM synced_sources)"
+            ).fetchall():
+                if (self.data_path / source_name / "intake.json").exists():
+                    self.sync_source(source_name, open_index(source_name))
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('channels_mtime', ?)", (mtime,)
+            )
+
+    def set_channels(self, channels: Dict[str, List[str]]) -> None:
+        """
+        Replace the channel members, changing only the rows that differ.
+        """
+        wanted = {
+            (channel, source)
+            for channel, sources in channels.items()
+            for source in sources
+        }
+        current = set(self.db.execute("SELECT channel, source FROM channel_sources"))
+        with self.batch():
+            self.db.executemany(
+                "DELETE FROM channel_sources WHERE channel = ? AND source = ?",
+                current - wanted,
+            )
+            self.db.executemany(
+                "INSERT INTO channel_sources VALUES (?, ?)", wanted - current
+            )
+
+    def sorted_entries(
+        self, channel: str, visible_at: float, offset: int, limit: int
+    ) -> List[Tuple[str, str]]:
+        """
+        Get a page of the (source, item id) pairs of the visible items in a
+        channel, in feed order.
+        """
+        return self.db.execute(
+            "SELECT source, id FROM channel_items"
+            f" WHERE source IN ({CHANNEL_SOURCES}) AND {VISIBLE_CLAUSE}"
+            " ORDER BY sort_time, id, source LIMIT ? OFFSET ?",
+            (channel, visible_at, limit, offset),
+        ).fetchall()
+
+    def count(self, channel: str, visible_at: float) -> int:
+        return self.db.execute(
+            "SELECT COUNT(*) FROM channel_items"
+            f" WHERE source IN ({CHANNEL_SOURCES}) AND {VISIBLE_CLAUSE}",
+            (channel, visible_at),
+        ).fetchone()[0]
+
+    def channel_state(self, channel: str, now: float) -> list:
+        """
+        Get a value that changes whenever the visible items of a channel may
+        have changed: the synced generations of its sources and the next time
+        a hidden item becomes visible.
+        """
+        generations = self.db.execute(
+            "SELECT source, epoch, generation FROM synced_sources"
+            f" WHERE source IN ({CHANNEL_SOURCES}) ORDER BY source",
+            (channel,),
+        ).fetchall()
+        next_tts = self.db.execute(
+            "SELECT MIN(created + tts) FROM channel_items"
+            f" WHERE source IN ({CHANNEL_SOURCES}) AND created + tts > ?",
+            (channel, now),
+        ).fetchone()[0]
+        return [generations, next_tts]
@@ -1,18 +1,34 @@
 from datetime import datetime
 from pathlib import Path
 from shutil import get_terminal_size
+from typing import List
 import argparse
+import asyncio
 import getpass
+import heapq
+import itertools
 import json
 import os
 import os.path
 import pwd
+import signal
 import subprocess
 import sys
+import time
 
 from intake.core import intake_data_dir
 from intake.crontab import update_crontab_entries
-from intake.source import fetch_items, LocalSource, update_items, execute_action
+from intake.metrics import METRICS_FILENAME, REGISTRY
+from intake.source import (
+    FetchStatus,
+    fetch_items_async,
+    iter_fetch_items_async,
+    LocalSource,
+    reap_items,
+    update_items_async,
+    execute_action,
+)
+from intake.storage import STORAGE_TYPES
 from intake.types import InvalidConfigException, SourceUpdateException
 
 
@@ -73,13 +89,19 @@ def cmd_edit(cmd_args):
 
         # Check if the new config is valid
         try:
-            json.load(tmp_path.open())
+            new_config = json.load(tmp_path.open())
         except json.JSONDecodeError:
             yn = input("Invalid JSON. Return to editor? [Yn] ")
             if yn.strip().lower() != "n":
                 continue
             tmp_path.unlink()
             return 0
+        if new_config.get("storage", "files") != source.storage.name:
+            yn = input("Use intake migrate to change storage. Return to editor? [Yn] ")
+            if yn.strip().lower() != "n":
+                continue
+            tmp_path.unlink()
+            return 0
 
         tmp_path.replace(source.source_path / "intake.json")
 
@@ -92,7 +114,7 @@ def cmd_edit(cmd_args):
 
 
 def cmd_update(cmd_args):
-    """Fetch items for a source and update it."""
+    """Fetch items for sources and update them."""
     parser = argparse.ArgumentParser(
         prog="intake update",
         description=cmd_update.__doc__,
@@ -102,41 +124,272 @@ def cmd_update(cmd_args):
         "-d",
         help="Path to the intake data directory containing source directories",
     )
-    parser.add_argument(
+    which = parser.add_mutually_exclusive_group(required=True)
+    which.add_argument(
         "--source",
         "-s",
-        required=True,
-        help="Source name to fetch",
+        nargs="+",
+        help="Source names to fetch",
+    )
+    which.add_argument(
+        "--all",
+        "-a",
+        action="store_true",
+        help="Fetch all sources",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=4,
+        help="Number of sources to fetch in parallel",
     )
     parser.add_argument(
         "--dry-run",
         action="store_true",
         help="Instead of updating the source, print the fetched items",
     )
+    parser.add_argument(
+        "--write-metrics",
+        action="store_true",
+        help=f"Add this run's metrics to {METRICS_FILENAME} in the data directory",
+    )
     args = parser.parse_args(cmd_args)
 
     data_path: Path = Path(args.data) if args.data else intake_data_dir()
-    source = LocalSource(data_path, args.source)
+    sources = _get_sources(data_path, args.source)
+
+    results = asyncio.run(_update_sources(sources, args.jobs, args.dry_run))
+    if args.write_metrics:
+        REGISTRY.write_textfile(data_path / METRICS_FILENAME)
+
+    # Summarize the results when updating more than one source
+    if len(sources) > 1:
+        width = max(map(len, results))
+        for source in sources:
+            name = source.source_name
+            ok, elapsed = results[name]
+            if ok:
+                print(f"{name:<{width}}  ok      {elapsed:.2f}s", file=sys.stderr)
+            else:
+                print(f"{name:<{width}}  failed", file=sys.stderr)
+        failed = sum(1 for ok, _ in results.values() if not ok)
+        print(len(results) - failed, "succeeded,", failed, "failed", file=sys.stderr)
+
+    return 0 if all(ok for ok, _ in results.values()) else 1
+
+
+async def _update_sources(sources: List[LocalSource], jobs: int, dry_run: bool):
+    """
+    Fetch and update sources concurrently, at most `jobs` at a time. Items are
+    written as they are read from each fetch. Returns a map of source names to
+    success and elapsed time.
+    """
+    semaphore = asyncio.Semaphore(max(1, jobs))
+    results = {}
+
+    async def _update_source(source: LocalSource):
+        try:
+            async with semaphore:
+                start = time.perf_counter()
+                if not dry_run:
+                    status = FetchStatus()
+                    fetched = iter_fetch_items_async(source, status=status)
+                    await update_items_async(source, fetched, status)
+                else:
+                    items = await fetch_items_async(source)
+                    print(source, "returned", len(items), "items:")
+                    for item in items:
+                        print("  Item:", item.to_dict(), file=sys.stderr)
+                results[source.source_name] = (True, time.perf_counter() - start)
+        except InvalidConfigException as ex:
+            print("Could not fetch", source, file=sys.stderr)
+            print(ex, file=sys.stderr)
+            results[source.source_name] = (False, None)
+        except SourceUpdateException as ex:
+            print("Error updating source", source, file=sys.stderr)
+            print(ex, file=sys.stderr)
+            results[source.source_name] = (False, None)
+        except Exception as ex:
+            print("Unexpected error updating source", source, file=sys.stderr)
+            print(repr(ex), file=sys.stderr)
+            results[source.source_name] = (False, None)
+
+    await asyncio.gather(*[_update_source(source) for source in sources])
+    return results
+
+
+def cmd_scheduler(cmd_args):
+    """Run sources' cron schedules in a long-running process."""
+    parser = argparse.ArgumentParser(
+        prog="intake scheduler",
+        description=cmd_scheduler.__doc__,
+    )
+    parser.add_argument(
+        "--data",
+        "-d",
+        help="Path to the intake data directory containing source directories",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=4,
+        help="Number of sources to update in parallel",
+    )
+    parser.add_argument(
+        "--reload",
+        type=int,
+        default=60,
+        help="Seconds between checks for source config changes",
+    )
+    parser.add_argument(
+        "--write-metrics",
+        action="store_true",
+        help=f"Add metrics to {METRICS_FILENAME} in the data directory after updates",
+    )
+    args = parser.parse_args(cmd_args)
+
+    from intake.scheduler import Scheduler
+
+    data_path: Path = Path(args.data) if args.data else intake_data_dir()
+    scheduler = Scheduler(
+        data_path,
+        jobs=args.jobs,
+        reload_interval=args.reload,
+        metrics_path=data_path / METRICS_FILENAME if args.write_metrics else None,
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
     try:
-        items = fetch_items(source)
-        if not args.dry_run:
-            update_items(source, items)
-        else:
-            print("Update returned", len(items), "items:")
-            for item in items:
-                print("  Item:", item._item, file=sys.stderr)
-    except InvalidConfigException as ex:
-        print("Could not fetch", args.source, file=sys.stderr)
-        print(ex, file=sys.stderr)
-        return 1
-    except SourceUpdateException as ex:
-        print("Error updating source", args.source, file=sys.stderr)
-        print(ex, file=sys.stderr)
-        return 1
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.stop()
+    return 0
+
+
+def cmd_migrate(cmd_args):
+    """Move sources' items to a different storage."""
+    parser = argparse.ArgumentParser(
+        prog="intake migrate",
+        description=cmd_migrate.__doc__,
+    )
+    parser.add_argument(
+        "--data",
+        "-d",
+        help="Path to the intake data directory containing source directories",
+    )
+    which = parser.add_mutually_exclusive_group(required=True)
+    which.add_argument(
+        "--source",
+        "-s",
+        nargs="+",
+        help="Source names to migrate",
+    )
+    which.add_argument(
+        "--all",
+        "-a",
+        action="store_true",
+        help="Migrate all sources",
+    )
+    parser.add_argument(
+        "--storage",
+        required=True,
+        choices=STORAGE_TYPES,
+        help="Storage to move items to",
+    )
+    args = parser.parse_args(cmd_args)
+
+    data_path: Path = Path(args.data) if args.data else intake_data_dir()
+    for source in _get_sources(data_path, args.source):
+        old_storage = source.storage.name
+        count = source.convert_storage(args.storage)
+        print(f"{source}: moved {count} items from {old_storage}", file=sys.stderr)
+
+    return 0
+
+
+def cmd_compact(cmd_args):
+    """Remove dead records from sources' item storage."""
+    parser = argparse.ArgumentParser(
+        prog="intake compact",
+        description=cmd_compact.__doc__,
+    )
+    parser.add_argument(
+        "--data",
+        "-d",
+        help="Path to the intake data directory containing source directories",
+    )
+    which = parser.add_mutually_exclusive_group(required=True)
+    which.add_argument(
+        "--source",
+        "-s",
+        nargs="+",
+        help="Source names to compact",
+    )
+    which.add_argument(
+        "--all",
+        "-a",
+        action="store_true",
+        help="Compact all sources",
+    )
+    args = parser.parse_args(cmd_args)
+
+    data_path: Path = Path(args.data) if args.data else intake_data_dir()
+    for source in _get_sources(data_path, args.source):
+        if source.compact(force=True):
+            print(f"{source}: compacted", file=sys.stderr)
 
     return 0
 
 
+def cmd_reap(cmd_args):
+    """Delete expired items that are no longer fetched."""
+    parser = argparse.ArgumentParser(
+        prog="intake reap",
+        description=cmd_reap.__doc__,
+    )
+    parser.add_argument(
+        "--data",
+        "-d",
+        help="Path to the intake data directory containing source directories",
+    )
+    which = parser.add_mutually_exclusive_group(required=True)
+    which.add_argument(
+        "--source",
+        "-s",
+        nargs="+",
+        help="Source names to reap",
+    )
+    which.add_argument(
+        "--all",
+        "-a",
+        action="store_true",
+        help="Reap all sources",
+    )
+    args = parser.parse_args(cmd_args)
+
+    data_path: Path = Path(args.data) if args.data else intake_data_dir()
+    for source in _get_sources(data_path, args.source):
+        count = reap_items(source)
+        if count:
+            print(f"{source}: deleted {count} items", file=sys.stderr)
+
+    return 0
+
+
+def _get_sources(data_path: Path, names: List[str] = None) -> List[LocalSource]:
+    """
+    Get the named sources, or all sources if no names are given.
+    """
+    if not names:
+        names = sorted(
+            child.name
+            for child in data_path.iterdir()
+            if (child / "intake.json").exists()
+        )
+    return [LocalSource(data_path, name) for name in names]
+
+
 def cmd_action(cmd_args):
     """Execute an action for an item."""
     parser = argparse.ArgumentParser(
@@ -225,19 +478,21 @@ def cmd_feed(cmd_args):
         for name in args.sources
         if (data_path / name / "intake.json").exists()
     ]
-    items = sorted(
-        [item for source in sources for item in source.get_all_items()],
+    # Merge the sources' indexed items, which only read the other fields from
+    # storage as they are printed and never keep the item bodies
+    items = heapq.merge(
+        *[source.get_sorted_items(show_hidden=True) for source in sources],
         key=lambda item: item.sort_key,
     )
-
-    if not items:
+    first = next(items, None)
+    if first is None:
         print("Feed is empty")
         return 0
 
     size = get_terminal_size((80, 20))
     width = min(80, size.columns)
 
-    for item in items:
+    for item in itertools.chain([first], items):
         title = item.display_title
         titles = [title]
         while len(titles[-1]) > width - 4:
@@ -315,6 +570,12 @@ def cmd_run(cmd_args):
     )
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=64,
+        help="Approximate memory limit for cached items, in MB",
+    )
     args = parser.parse_args(cmd_args)
 
     data_path: Path = Path(args.data) if args.data else intake_data_dir()
@@ -322,6 +583,7 @@ def cmd_run(cmd_args):
         from intake.app import app
 
         app.config["INTAKE_DATA"] = data_path
+        app.config["INTAKE_CACHE_BYTES"] = args.cache_mb * 1024 * 1024
         app.run(port=args.port, debug=args.debug)
         return 0
     except Exception as ex:
@@ -0,0 +1,100 @@
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import json
+import os
+import time
+
+
+# How long a cached config is used before its file is checked for changes.
+DEFAULT_MAX_AGE = 1.0
+
+# A file modified this recently may be changed again without its stat stamp
+# changing, e.g. a source directory whose intake.json is written right after
+# the directory is created, so it is read again at the next check.
+RACY_SECONDS = 2.0
+
+Stamp = Optional[Tuple[int, int, int]]
+
+
+class ConfigCache:
+    """
+    A cache of parsed config files and of the list of sources in a data
+    directory that can be shared between LocalSource instances and requests.
+    Each entry is stored with a stamp of its file's stat and is only checked
+    against the file once every max_age seconds, so edits made by other
+    processes are picked up shortly after they are made. Edits made through
+    this process should invalidate the entry so they are seen immediately.
+
+    Cached values are shared and must not be modified.
+    """
+
+    def __init__(self, max_age: float = DEFAULT_MAX_AGE):
+        self.max_age = max_age
+        # Path to (stamp, whether the stamp can be trusted, last check, value)
+        self._entries: Dict[Path, Tuple[Stamp, bool, float, Any]] = {}
+        self._lock = Lock()
+
+    def read_json(self, path: Path) -> Any:
+        """
+        Get the parsed contents of a JSON file, or None if it does not exist.
+        """
+        return self._get(path, lambda: _load_json(path))
+
+    def list_sources(self, data_path: Path) -> List[str]:
+        """
+        Get the names of the sources in a data directory.
+        """
+        return self._get(data_path, lambda: _scan_sources(data_path))
+
+    def invalidate(self, path: Path = None) -> None:
+        """
+        Drop the cached value for a path, or for all paths if none is given.
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def _get(self, path: Path, load: Callable[[], Any]) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and now - entry[2] < self.max_age:
+            return entry[3]
+
+        # Stamp before loading, so a change made during the load is seen at
+        # the next check
+        stamp = _stamp(path)
+        if entry is not None and entry[1] and entry[0] == stamp:
+            value = entry[3]
+        else:
+            value = load()
+        settled = stamp is None or time.time() - stamp[0] / 1e9 > RACY_SECONDS
+        with self._lock:
+            self._entries[path] = (stamp, settled, now, value)
+        return value
+
+
+def _stamp(path: Path) -> Stamp:
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def _load_json(path: Path) -> Any:
+    try:
+        return json.loads(path.read_text(encoding="utf8"))
+    except FileNotFoundError:
+        return None
+
+
+def _scan_sources(data_path: Path) -> List[str]:
+    try:
+        children = list(data_path.iterdir())
+    except FileNotFoundError:
+        return []
+    return sorted(child.name for child in children if (child / "intake.json").exists())
@@ -1,19 +1,129 @@
+from datetime import datetime, timedelta
 from pathlib import Path
+from typing import List, Set
 import os
 import subprocess
 import sys
 
 from intake.source import LocalSource
+from intake.types import InvalidConfigException
 
 
 INTAKE_CRON_BEGIN = "### begin intake-managed crontab entries"
 INTAKE_CRON_END = "### end intake-managed crontab entries"
 
 
+class CronSchedule:
+    """
+    A parsed crontab schedule spec, e.g. "*/15 * * * *".
+    """
+
+    # The name and allowed range of each field, in order.
+    FIELDS = (
+        ("minute", 0, 59),
+        ("hour", 0, 23),
+        ("day of month", 1, 31),
+        ("month", 1, 12),
+        ("day of week", 0, 7),
+    )
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        parts = spec.split()
+        if len(parts) != 5:
+            raise InvalidConfigException(f"Cron spec must have 5 fields: {spec}")
+        fields = [
+            _parse_cron_field(part, name, low, high)
+            for part, (name, low, high) in zip(parts, self.FIELDS)
+        ]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = fields
+        # Sunday is both 0 and 7
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        # As in cron, if both day fields are restricted, either may match
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    def __str__(self) -> str:
+        return self.spec
+
+    def _day_matches(self, dt: datetime) -> bool:
+        day_match = dt.day in self.days
+        # datetime weekdays start on Monday, cron weekdays start on Sunday
+        weekday_match = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday_match
+        if self.any_weekday:
+            return day_match
+        return day_match or weekday_match
+
+    def next_after(self, after: datetime) -> datetime:
+        """
+        Get the first time strictly after the given time that matches.
+        """
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Skip forward by the largest non-matching unit. Four years of
+        # skipping covers every valid schedule, including leap days.
+        limit = after + timedelta(days=4 * 366 + 1)
+        while dt <= limit:
+            if dt.month not in self.months:
+                month = dt.month % 12 + 1
+                dt = dt.replace(
+                    year=dt.year + (month == 1), month=month, day=1, hour=0, minute=0
+                )
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise InvalidConfigException(f"Cron spec never matches: {self.spec}")
+
+
+def _parse_cron_field(field: str, name: str, low: int, high: int) -> Set[int]:
+    """
+    Parse one field of a cron spec into the set of values it matches.
+    Supports *, single values, ranges, steps, and comma-separated lists.
+    """
+    values: Set[int] = set()
+    for part in field.split(","):
+        range_part, _, step_part = part.partition("/")
+        try:
+            step = int(step_part) if step_part else 1
+            if range_part == "*":
+                start, end = low, high
+            elif "-" in range_part:
+                start, end = map(int, range_part.split("-", 1))
+            else:
+                start = int(range_part)
+                end = high if step_part else start
+        except ValueError:
+            raise InvalidConfigException(f"Invalid cron {name}: {field}")
+        if step < 1 or start < low or end > high or start > end:
+            raise InvalidConfigException(f"Invalid cron {name}: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def crontab_enabled() -> bool:
+    """
+    Whether intake manages crontab entries for the sources' cron schedules.
+    Setting INTAKE_CRONTAB=0 turns this off for when intake scheduler runs the
+    schedules instead.
+    """
+    return os.environ.get("INTAKE_CRONTAB", "1") != "0"
+
+
 def get_desired_crons(data_path: Path):
     """
-    Get a list of sources and crontab specs from the data directory.
+    Get a list of sources and crontab specs from the data directory. If
+    crontab management is turned off, there are none, so that updating the
+    crontab removes any entries left from before.
     """
+    if not crontab_enabled():
+        return
     for child in data_path.iterdir():
         if not (child / "intake.json").exists():
             continue
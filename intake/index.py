@@ -0,0 +1,350 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple
+import json
+import sqlite3
+
+
+INDEX_FILENAME = "index.db"
+
+# Item fields that are stored in the index. These are all the fields needed to
+# filter, sort, and expire items without reading the full item.
+INDEX_FIELDS = ("id", "created", "time", "active", "tts", "ttl", "ttd", "tags")
+
+# The version of the schema below, kept in the index's user_version. Version 1
+# added the deadlines and stale tables.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id TEXT PRIMARY KEY,
+    created INTEGER NOT NULL,
+    time INTEGER,
+    active INTEGER NOT NULL,
+    tts INTEGER,
+    ttl INTEGER,
+    ttd INTEGER,
+    tags TEXT,
+    sort_time INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_sort ON items (sort_time, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('epoch', abs(random()));
+INSERT OR IGNORE INTO meta VALUES ('generation', 0);
+CREATE TABLE IF NOT EXISTS deadlines (
+    id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    at INTEGER NOT NULL,
+    PRIMARY KEY (id, kind)
+);
+CREATE INDEX IF NOT EXISTS deadlines_at ON deadlines (kind, at);
+CREATE TABLE IF NOT EXISTS stale (
+    id TEXT PRIMARY KEY
+);
+"""
+
+# The times at which an item stops being hidden by its tts ("show") and at
+# which it can be removed once it is no longer fetched ("remove"), see
+# Item.before_tts and Item.can_remove. An active item without a ttd can only
+# be removed after it is deactivated, so it has no remove deadline.
+DEADLINES = """
+INSERT OR REPLACE INTO deadlines
+SELECT id, 'show', created + tts FROM items
+WHERE active = 1 AND tts IS NOT NULL AND {where}
+UNION ALL
+SELECT id, 'remove', CASE
+    WHEN active = 0 THEN COALESCE(created + ttl, created)
+    ELSE MAX(created + ttd, COALESCE(created + ttl, created))
+END FROM items
+WHERE (active = 0 OR ttd IS NOT NULL) AND {where}
+"""
+
+# Fill in the deadlines of an index written before they were kept
+BACKFILL_DEADLINES = (
+    DEADLINES.format(where="NOT EXISTS (SELECT * FROM meta WHERE key = 'deadlines')")
+    + ";\nINSERT OR IGNORE INTO meta VALUES ('deadlines', 1);"
+)
+
+MIGRATE = f"""
+BEGIN IMMEDIATE;
+{SCHEMA}
+{BACKFILL_DEADLINES}
+PRAGMA user_version = {SCHEMA_VERSION};
+COMMIT;
+"""
+
+SELECT_ENTRIES = "SELECT id, created, time, active, tts, ttl, ttd, tags FROM items"
+
+# Matches the items that are not hidden, see Item.is_hidden.
+VISIBLE_CLAUSE = " WHERE active = 1 AND (tts IS NULL OR created + tts <= ?)"
+
+
+class ItemIndex:
+    """
+    A SQLite sidecar file in a source directory that holds the metadata fields
+    of every item in the source.
+    """
+
+    def __init__(self, index_path: Path):
+        self.index_path = index_path
+        self._db: Optional[sqlite3.Connection] = None
+        self._batch_depth = 0
+        self._changed = False
+
+    @property
+    def exists(self) -> bool:
+        return self.index_path.exists()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            # Autocommit mode, so single writes are committed immediately and
+            # batch() can manage its own transactions.
+            db = sqlite3.connect(str(self.index_path), timeout=30, isolation_level=None)
+            # Only a new or outdated index is written to when it is opened, so
+            # that opening an index to read it doesn't wait for a writer
+            (version,) = db.execute("PRAGMA user_version").fetchone()
+            if version < SCHEMA_VERSION:
+                _migrate(db)
+            self._db = db
+        return self._db
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextmanager
+    def batch(self):
+        """
+        Group index writes into a single transaction. The transaction is
+        committed even if the batch is interrupted, since the index mirrors
+        item file changes that have already happened.
+        """
+        if self._batch_depth == 0:
+            self.db.execute("BEGIN IMMEDIATE")
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                if self._changed:
+                    self._bump_generation()
+                self.db.execute("COMMIT")
+
+    def _mark_changed(self) -> None:
+        # Bump the generation once per batch instead of once per write
+        if self._batch_depth:
+            self._changed = True
+        else:
+            self._bump_generation()
+
+    def _bump_generation(self) -> None:
+        self.db.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        self._changed = False
+
+    def generation(self) -> Tuple[int, int]:
+        """
+        Get a value that changes whenever the index is written. The epoch part
+        distinguishes a rebuilt index from the one it replaced.
+        """
+        values = dict(self.db.execute("SELECT key, value FROM meta"))
+        return values["epoch"], values["generation"]
+
+    def pending_generation(self) -> Tuple[int, int]:
+        """
+        Get the generation the index will have once the current batch is
+        committed.
+        """
+        epoch, generation = self.generation()
+        return epoch, generation + 1 if self._changed else generation
+
+    def next_tts(self, after: float) -> Optional[int]:
+        """
+        Get the earliest time after the given time at which an active item
+        stops being hidden by its tts.
+        """
+        row = self.db.execute(
+            "SELECT MIN(at) FROM deadlines WHERE kind = 'show' AND at > ?",
+            (after,),
+        ).fetchone()
+        return row[0]
+
+    def next_removal(self) -> Optional[int]:
+        """
+        Get the earliest time at which an item that was not in the latest
+        fetch can be removed. This may be in the past.
+        """
+        row = self.db.execute(
+            "SELECT MIN(at) FROM deadlines"
+            " WHERE kind = 'remove' AND id IN (SELECT id FROM stale)"
+        ).fetchone()
+        return row[0]
+
+    def due_removals(self, now: float) -> Iterator[dict]:
+        """
+        Get the indexed fields of the items that were not in the latest fetch
+        and whose removal deadline has passed.
+        """
+        query = (
+            "SELECT items.id, created, time, active, tts, ttl, ttd, tags"
+            " FROM deadlines JOIN items USING (id)"
+            " WHERE kind = 'remove' AND at <= ?"
+            " AND deadlines.id IN (SELECT id FROM stale)"
+        )
+        for row in self.db.execute(query, (now,)).fetchall():
+            yield _row_to_entry(row)
+
+    def set_stale(self, item_ids: Iterable[str]) -> None:
+        """
+        Record which items were not in the latest fetch. Only these items are
+        removed when their removal deadline passes.
+        """
+        self.db.execute("DELETE FROM stale")
+        self.db.executemany(
+            "INSERT OR IGNORE INTO stale VALUES (?)", ((i,) for i in item_ids)
+        )
+
+    def mark_stale(self, stale_ids: Iterable[str], fresh_ids: Iterable[str]) -> None:
+        """
+        Update which items were not in the latest fetch after a fetch that only
+        included the items that changed, given the items it deleted and the
+        items it included.
+        """
+        self.db.executemany("DELETE FROM stale WHERE id = ?", ((i,) for i in fresh_ids))
+        self.db.executemany(
+            "INSERT OR IGNORE INTO stale VALUES (?)", ((i,) for i in stale_ids)
+        )
+
+    def put(self, item: dict) -> None:
+        """
+        Insert or replace the index entry for an item.
+        """
+        tags = item.get("tags")
+        self.db.execute(
+            "INSERT OR REPLACE INTO items"
+            " (id, created, time, active, tts, ttl, ttd, tags, sort_time)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                item["id"],
+                item["created"],
+                item.get("time"),
+                1 if item["active"] else 0,
+                item.get("tts"),
+                item.get("ttl"),
+                item.get("ttd"),
+                json.dumps(tags) if tags is not None else None,
+                item.get("time") or item["created"],
+            ),
+        )
+        self.db.execute("DELETE FROM deadlines WHERE id = ?", (item["id"],))
+        self.db.execute(DEADLINES.format(where="id = ?"), (item["id"], item["id"]))
+        self._mark_changed()
+
+    def remove(self, item_id: str) -> None:
+        self.db.execute("DELETE FROM items WHERE id = ?", (item_id,))
+        self.db.execute("DELETE FROM deadlines WHERE id = ?", (item_id,))
+        self.db.execute("DELETE FROM stale WHERE id = ?", (item_id,))
+        self._mark_changed()
+
+    def clear(self) -> None:
+        self.db.execute("DELETE FROM items")
+        self.db.execute("DELETE FROM deadlines")
+        self._mark_changed()
+
+    def count(self, visible_at: float = None) -> int:
+        """
+        Count the indexed items. If visible_at is specified, only count the
+        items that are not hidden at that time.
+        """
+        query = "SELECT COUNT(*) FROM items"
+        params = ()
+        if visible_at is not None:
+            query += VISIBLE_CLAUSE
+            params = (visible_at,)
+        return self.db.execute(query, params).fetchone()[0]
+
+    def ids(self) -> Iterator[str]:
+        for (item_id,) in self.db.execute("SELECT id FROM items"):
+            yield item_id
+
+    def entries(self) -> Iterator[dict]:
+        """
+        Get the indexed fields of every item.
+        """
+        for row in self.db.execute(SELECT_ENTRIES):
+            yield _row_to_entry(row)
+
+    def sorted_entries(self, visible_at: float = None) -> Iterator[dict]:
+        """
+        Get the indexed fields of every item in feed order. If visible_at is
+        specified, skip the items that are hidden at that time.
+        """
+        query = SELECT_ENTRIES
+        params = ()
+        if visible_at is not None:
+            query += VISIBLE_CLAUSE
+            params = (visible_at,)
+        query += " ORDER BY sort_time, id"
+        for row in self.db.execute(query, params):
+            yield _row_to_entry(row)
+
+    def active_entries(
+        self,
+        visible_at: float = None,
+        created_before: int = None,
+        time_before: int = None,
+    ) -> Iterator[dict]:
+        """
+        Get the indexed fields of every active item, optionally only those
+        that are visible at a time or are older than a cutoff. The time cutoff
+        uses the item time if it has one and the created time otherwise, as
+        feeds do.
+        """
+        query = SELECT_ENTRIES
+        params = []
+        if visible_at is not None:
+            query += VISIBLE_CLAUSE
+            params.append(visible_at)
+        else:
+            query += " WHERE active = 1"
+        if created_before is not None:
+            query += " AND created < ?"
+            params.append(created_before)
+        if time_before is not None:
+            query += " AND sort_time < ?"
+            params.append(time_before)
+        for row in self.db.execute(query, params):
+            yield _row_to_entry(row)
+
+
+def _migrate(db: sqlite3.Connection) -> None:
+    # In WAL mode, readers don't wait for a batch to be committed. This is
+    # kept by the file, so it only needs to be set once.
+    db.execute("PRAGMA journal_mode = WAL")
+    try:
+        db.executescript(MIGRATE)
+    except sqlite3.Error:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        raise
+
+
+def _row_to_entry(row: tuple) -> dict:
+    """
+    Convert an index row back into a partial item dict.
+    """
+    entry = {}
+    for field, value in zip(INDEX_FIELDS, row):
+        if value is None:
+            continue
+        if field == "active":
+            value = bool(value)
+        elif field == "tags":
+            value = json.loads(value)
+        entry[field] = value
+    return entry
@@ -0,0 +1,109 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from random import getrandbits
+from threading import Lock
+from typing import Any, Callable, Deque, Dict, Hashable, Optional
+import sys
+import time
+
+
+# How many jobs may run at once by default.
+DEFAULT_JOB_WORKERS = 4
+
+# How long the result of a finished job is kept for polling.
+JOB_RETENTION_SECONDS = 600
+
+
+class Job:
+    """
+    A unit of work in a JobQueue and its outcome.
+    """
+
+    def __init__(self, key: Hashable, func: Callable[[], Any]):
+        self.id = "{:x}".format(getrandbits(16 * 4))
+        self.key = key
+        self.func = func
+        # One of "queued", "running", "done", or "failed"
+        self.status = "queued"
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.finished: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed")
+
+
+class JobQueue:
+    """
+    Runs jobs on a pool of threads and keeps their results for a while so they
+    can be polled. Jobs with the same key are run one at a time in the order
+    they were submitted, and jobs with different keys run in parallel.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._jobs: Dict[str, Job] = {}
+        # The jobs waiting to run for each key with a job running
+        self._pending: Dict[Hashable, Deque[Job]] = {}
+        self._lock = Lock()
+
+    def submit(self, key: Hashable, func: Callable[[], Any]) -> Job:
+        """
+        Queue a job. Its result is the return value of func, and it fails if
+        func raises an exception.
+        """
+        job = Job(key, func)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            if key in self._pending:
+                self._pending[key].append(job)
+                return job
+            self._pending[key] = deque([job])
+        self.executor.submit(self._run_key, key)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run_key(self, key: Hashable) -> None:
+        # Run the jobs for a key until there are none left, so that a job
+        # submitted while another with the same key is running waits for it
+        while True:
+            with self._lock:
+                pending = self._pending[key]
+                if not pending:
+                    del self._pending[key]
+                    return
+                job = pending.popleft()
+                job.status = "running"
+            try:
+                result = job.func()
+            except Exception as ex:
+                print(f"Job {job.id} failed: {ex!r}", file=sys.stderr)
+                with self._lock:
+                    job.error = str(ex) or type(ex).__name__
+                    job.status = "failed"
+                    job.finished = time.monotonic()
+            else:
+                with self._lock:
+                    job.result = result
+                    job.status = "done"
+                    job.finished = time.monotonic()
+            finally:
+                job.func = None
+
+    def _prune(self) -> None:
+        cutoff = time.monotonic() - JOB_RETENTION_SECONDS
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished is not None and job.finished < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,326 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterator, List, Sequence, Tuple
+import fcntl
+import math
+import os
+import re
+
+
+# The file in the data directory that CLI runs write their metrics to, so that
+# the web process can include them in /metrics.
+METRICS_FILENAME = "metrics.prom"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# A sample is identified by its name and its sorted label pairs.
+SampleKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+SAMPLE_LINE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$")
+LABEL_PAIR = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+class Registry:
+    """
+    A collection of metrics that can be rendered in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, "Metric"] = {}
+        # The samples as of the last write_textfile(), so that each write only
+        # adds what changed since
+        self._written: Dict[SampleKey, float] = {}
+        self._write_lock = Lock()
+
+    def register(self, metric: "Metric") -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f"Duplicate metric {metric.name}")
+        self.metrics[metric.name] = metric
+
+    def collect(self) -> Dict[SampleKey, float]:
+        samples = {}
+        for metric in self.metrics.values():
+            samples.update(metric.collect())
+        return samples
+
+    def render(self, extra: Dict[SampleKey, float] = None) -> str:
+        """
+        Render all metrics, adding the values of any extra samples, such as
+        those read from a textfile.
+        """
+        samples = self.collect()
+        for key, value in (extra or {}).items():
+            samples[key] = samples.get(key, 0.0) + value
+
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            names = metric.sample_names()
+            owned = [key for key in samples if key[0] in names]
+            for name, labels in sorted(owned, key=metric.sort_key):
+                value = _format_value(samples[(name, labels)])
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: Path) -> None:
+        """
+        Add the changes in this process's metrics since the last write to a
+        textfile. Multiple processes may write to the same textfile.
+        """
+        with self._write_lock, _locked(path):
+            samples = self.collect()
+            totals = read_textfile(path)
+            for key, value in samples.items():
+                delta = value - self._written.get(key, 0.0)
+                if delta or key not in totals:
+                    totals[key] = totals.get(key, 0.0) + delta
+            self._written = samples
+
+            tmp_path = path.with_name(f"{path.name}.tmp")
+            lines = [
+                f"{name}{_format_labels(labels)} {_format_value(value)}"
+                for (name, labels), value in sorted(totals.items())
+            ]
+            tmp_path.write_text("\n".join(lines) + "\n", encoding="utf8")
+            os.rename(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+
+class Metric(ABC):
+    """
+    Base class for metrics. Label values are given as keyword arguments.
+    """
+
+    type: str = None
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        registry: Registry = REGISTRY,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        registry.register(self)
+
+    def _labels(self, labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def sample_names(self) -> Tuple[str, ...]:
+        return (self.name,)
+
+    def sort_key(self, key: SampleKey):
+        return key[1]
+
+    @abstractmethod
+    def collect(self) -> Dict[SampleKey, float]:
+        """
+        Get the current value of each sample.
+        """
+
+
+class Counter(Metric):
+    """
+    A value that only goes up.
+    """
+
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> Dict[SampleKey, float]:
+        with self._lock:
+            return {(self.name, key): value for key, value in self._values.items()}
+
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, counted in cumulative buckets.
+    """
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Label values to per-bucket counts and the sum of observed values
+        self._values: Dict[Tuple[Tuple[str, str], ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._labels(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """
+        Observe the time spent in a block.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def sample_names(self) -> Tuple[str, ...]:
+        return (f"{self.name}_bucket", f"{self.name}_sum", f"{self.name}_count")
+
+    def sort_key(self, key: SampleKey):
+        # Group the samples of each label set, with buckets in order
+        name, labels = key
+        le = dict(labels).get("le")
+        base = tuple(pair for pair in labels if pair[0] != "le")
+        return base, self.sample_names().index(name), float(le or 0)
+
+    def collect(self) -> Dict[SampleKey, float]:
+        samples = {}
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = key + (("le", _format_value(bound)),)
+                    samples[(f"{self.name}_bucket", labels)] = cumulative
+                samples[(f"{self.name}_sum", key)] = total
+                samples[(f"{self.name}_count", key)] = cumulative
+        return samples
+
+
+def read_textfile(path: Path) -> Dict[SampleKey, float]:
+    """
+    Read the samples in a textfile written by write_textfile().
+    """
+    samples = {}
+    try:
+        text = path.read_text(encoding="utf8")
+    except FileNotFoundError:
+        return samples
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = SAMPLE_LINE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        pairs = tuple(
+            (label, _unescape(escaped))
+            for label, escaped in LABEL_PAIR.findall(labels or "")
+        )
+        samples[(name, pairs)] = float(value)
+    return samples
+
+
+@contextmanager
+def _locked(path: Path):
+    """
+    Lock a textfile against writers in other processes.
+    """
+    lock_path = path.with_name(f"{path.name}.lock")
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _unescape(value: str) -> str:
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), value)
+
+
+# Metrics for the hot paths in intake
+
+ACTION_DURATION = Histogram(
+    "intake_action_duration_seconds",
+    "Time from spawning a source action to its exit",
+    ["source", "action"],
+)
+ACTION_OUTPUT_BYTES = Counter(
+    "intake_action_output_bytes_total",
+    "Bytes read from the stdout of source actions",
+    ["source", "action"],
+)
+FETCH_ITEMS = Counter(
+    "intake_fetch_items_total",
+    "Items parsed from fetch output",
+    ["source"],
+)
+UPDATE_PHASE_DURATION = Histogram(
+    "intake_update_phase_seconds",
+    "Time spent in each phase of updating a source",
+    ["phase"],
+)
+UPDATE_ITEMS = Counter(
+    "intake_update_items_total",
+    "Items added, changed, and deleted by updates and reaped after expiring",
+    ["result"],
+)
+FEED_ITEMS = Counter(
+    "intake_feed_items_total",
+    "Items sorted, loaded, and rendered for feed pages",
+    ["stage"],
+)
+FEED_DURATION = Histogram(
+    "intake_feed_seconds",
+    "Time spent loading and rendering feed pages",
+    ["stage"],
+)
+ITEM_READS = Counter(
+    "intake_item_reads_total",
+    "Items read from storage",
+    ["storage"],
+)
+ITEM_WRITES = Counter(
+    "intake_item_writes_total",
+    "Items written to storage",
+    ["storage"],
+)
+ITEM_DELETES = Counter(
+    "intake_item_deletes_total",
+    "Items deleted from storage",
+    ["storage"],
+)
+ITEM_CACHE_HITS = Counter(
+    "intake_item_cache_hits_total",
+    "Items read from the item cache instead of storage",
+)
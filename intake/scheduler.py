@@ -0,0 +1,240 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from threading import Event, Lock
+from typing import Dict, List, Optional, Set, Tuple
+import heapq
+import itertools
+import sys
+import time
+
+from intake.crontab import CronSchedule
+from intake.metrics import REGISTRY
+from intake.source import (
+    FetchStatus,
+    LocalSource,
+    iter_fetch_items,
+    reap_items,
+    update_items,
+)
+from intake.types import InvalidConfigException, SourceUpdateException
+
+
+class Scheduler:
+    """
+    A long-running process that updates sources according to the cron specs
+    in their configs, replacing the intake-managed crontab entries. Items that
+    expire between updates are removed when they expire.
+    """
+
+    def __init__(
+        self,
+        data_path: Path,
+        jobs: int = 4,
+        reload_interval: int = 60,
+        metrics_path: Optional[Path] = None,
+    ):
+        self.data_path = data_path
+        self.reload_interval = reload_interval
+        # If set, metrics are added to this textfile after each update
+        self.metrics_path = metrics_path
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.stopped = Event()
+        # Set to wake the run loop when its next wake-up time may be sooner
+        self.wakeup = Event()
+
+        # The current schedule and the config mtime it was read from
+        self.schedules: Dict[str, CronSchedule] = {}
+        self.config_mtimes: Dict[str, int] = {}
+
+        # A timer queue of (time, sequence, source name, schedule) entries.
+        # Entries whose schedule no longer matches self.schedules are stale.
+        self.queue: List[Tuple[datetime, int, str, CronSchedule]] = []
+        self.sequence = itertools.count()
+
+        # A timer queue of (time, sequence, source name) entries for removing
+        # expired items between updates. Entries whose time no longer matches
+        # self.reap_times are stale. Updates reschedule these from worker
+        # threads, so they are guarded by a lock.
+        self.reap_queue: List[Tuple[float, int, str]] = []
+        self.reap_times: Dict[str, float] = {}
+        self.reap_lock = Lock()
+
+        # Sources with an update in progress
+        self.running: Set[str] = set()
+        self.running_lock = Lock()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.wakeup.set()
+
+    def run(self) -> None:
+        """
+        Run scheduled updates until stopped.
+        """
+        next_reload = 0.0
+        while not self.stopped.is_set():
+            if time.monotonic() >= next_reload:
+                self.reload()
+                next_reload = time.monotonic() + self.reload_interval
+
+            # Start everything that is due
+            now = datetime.now()
+            while self.queue and self.queue[0][0] <= now:
+                _, _, name, schedule = heapq.heappop(self.queue)
+                if self.schedules.get(name) is not schedule:
+                    continue
+                self.start_update(name)
+                try:
+                    self.enqueue(name, schedule, schedule.next_after(now))
+                except InvalidConfigException as ex:
+                    print(f"Could not schedule {name}: {ex}", file=sys.stderr)
+                    del self.schedules[name]
+            for name in self.pop_due_reaps(time.time()):
+                self.start_reap(name)
+
+            # Sleep until the next update, reap, or reload. Reaps queued after
+            # the wait is computed set the wakeup event so they aren't missed.
+            self.wakeup.clear()
+            wait = next_reload - time.monotonic()
+            if self.queue:
+                until_next = (self.queue[0][0] - datetime.now()).total_seconds()
+                wait = min(wait, until_next)
+            with self.reap_lock:
+                if self.reap_queue:
+                    wait = min(wait, self.reap_queue[0][0] - time.time())
+            self.wakeup.wait(max(0.0, wait))
+
+        self.executor.shutdown(wait=True)
+
+    def reload(self) -> None:
+        """
+        Pick up added, removed, and changed sources.
+        """
+        seen = set()
+        for child in self.data_path.iterdir():
+            config_path = child / "intake.json"
+            try:
+                mtime = config_path.stat().st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            name = child.name
+            seen.add(name)
+            if self.config_mtimes.get(name) == mtime:
+                continue
+            if name not in self.config_mtimes:
+                self.schedule_reap(name)
+            self.config_mtimes[name] = mtime
+
+            try:
+                config = LocalSource(self.data_path, name).get_config()
+                spec = config.get("cron")
+                schedule = CronSchedule(spec) if spec else None
+                # A spec can parse but never match, e.g. February 31st
+                next_time = schedule.next_after(datetime.now()) if schedule else None
+            except (ValueError, InvalidConfigException) as ex:
+                print(f"Could not schedule {name}: {ex}", file=sys.stderr)
+                schedule = None
+
+            old = self.schedules.pop(name, None)
+            if schedule is None:
+                if old:
+                    print(f"Unscheduled {name}", file=sys.stderr)
+                continue
+            if old and old.spec == schedule.spec:
+                self.schedules[name] = old
+                continue
+            self.schedules[name] = schedule
+            self.enqueue(name, schedule, next_time)
+            print(f"Scheduled {name} at {schedule}", file=sys.stderr)
+
+        for name in set(self.schedules) - seen:
+            del self.schedules[name]
+            print(f"Unscheduled {name}", file=sys.stderr)
+        for name in set(self.config_mtimes) - seen:
+            del self.config_mtimes[name]
+
+    def enqueue(self, name: str, schedule: CronSchedule, next_time: datetime) -> None:
+        heapq.heappush(self.queue, (next_time, next(self.sequence), name, schedule))
+
+    def schedule_reap(self, name: str) -> None:
+        """
+        Queue a reap of a source for when its next item expires.
+        """
+        try:
+            at = LocalSource(self.data_path, name).index.next_removal()
+        except Exception as ex:
+            print(f"Could not schedule reaping {name}: {ex!r}", file=sys.stderr)
+            at = None
+        with self.reap_lock:
+            if at is None:
+                self.reap_times.pop(name, None)
+            elif self.reap_times.get(name) != at:
+                self.reap_times[name] = at
+                heapq.heappush(self.reap_queue, (at, next(self.sequence), name))
+                self.wakeup.set()
+
+    def pop_due_reaps(self, now: float) -> List[str]:
+        due = []
+        with self.reap_lock:
+            while self.reap_queue and self.reap_queue[0][0] <= now:
+                at, _, name = heapq.heappop(self.reap_queue)
+                if self.reap_times.get(name) != at:
+                    continue
+                del self.reap_times[name]
+                due.append(name)
+        return due
+
+    def start_update(self, name: str) -> None:
+        """
+        Submit an update for a source, unless it is already updating.
+        """
+        with self.running_lock:
+            if name in self.running:
+                print(f"Skipping {name}, previous run still going", file=sys.stderr)
+                return
+            self.running.add(name)
+        self.executor.submit(self._update, name)
+
+    def start_reap(self, name: str) -> None:
+        """
+        Submit a reap for a source. If the source is updating, the update
+        deletes the expired items or schedules another reap.
+        """
+        with self.running_lock:
+            if name in self.running:
+                return
+            self.running.add(name)
+        self.executor.submit(self._reap, name)
+
+    def _update(self, name: str) -> None:
+        try:
+            source = LocalSource(self.data_path, name)
+            start = time.perf_counter()
+            status = FetchStatus()
+            update_items(source, iter_fetch_items(source, status=status), status)
+            elapsed = time.perf_counter() - start
+            print(f"Updated {name} in {elapsed:.2f}s", file=sys.stderr)
+        except (InvalidConfigException, SourceUpdateException) as ex:
+            print(f"Error updating {name}: {ex}", file=sys.stderr)
+        except Exception as ex:
+            print(f"Unexpected error updating {name}: {ex!r}", file=sys.stderr)
+        finally:
+            with self.running_lock:
+                self.running.discard(name)
+            self.schedule_reap(name)
+            if self.metrics_path:
+                REGISTRY.write_textfile(self.metrics_path)
+
+    def _reap(self, name: str) -> None:
+        try:
+            count = reap_items(LocalSource(self.data_path, name))
+            print(f"Reaped {count} items from {name}", file=sys.stderr)
+        except Exception as ex:
+            print(f"Unexpected error reaping {name}: {ex!r}", file=sys.stderr)
+        finally:
+            with self.running_lock:
+                self.running.discard(name)
+            self.schedule_reap(name)
+            if self.metrics_path:
+                REGISTRY.write_textfile(self.metrics_path)
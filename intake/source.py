@@ -1,41 +1,208 @@
-from datetime import timedelta
+from asyncio.subprocess import PIPE
+from contextlib import contextmanager
+from itertools import islice
 from pathlib import Path
-from subprocess import Popen, PIPE, TimeoutExpired
-from threading import Thread
-from time import time as current_time
-from typing import List
+from time import perf_counter, time as current_time
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import asyncio
 import json
 import os
 import os.path
+import resource
+import signal
 import sys
 
+from intake.cache import ItemCache
+from intake.channels import ChannelIndex
+from intake.config import ConfigCache
+from intake.index import ItemIndex, INDEX_FIELDS
+from intake.metrics import (
+    ACTION_DURATION,
+    ACTION_OUTPUT_BYTES,
+    FETCH_ITEMS,
+    ITEM_CACHE_HITS,
+    ITEM_DELETES,
+    ITEM_READS,
+    ITEM_WRITES,
+    UPDATE_ITEMS,
+    UPDATE_PHASE_DURATION,
+)
+from intake.storage import FileStorage, ItemStorage, open_storage
 from intake.types import InvalidConfigException, SourceUpdateException
+from intake.workers import (
+    KILL_GRACE_SECONDS,
+    Limits,
+    STOP_POLL_SECONDS,
+    WORKERS,
+    apply_limits,
+    process_group_running,
+    signal_process_group,
+)
+
+
+# The longest line that can be read from an action process by default.
+STREAM_LIMIT = 16 * 1024 * 1024
+
+# The number of fetched items written per index transaction. Committing in
+# chunks keeps the index from being locked for the entire fetch.
+UPDATE_CHUNK_SIZE = 500
+
+
+# Item fields that are kept in typed slots. Any other fields are kept in a dict.
+ITEM_FIELDS = (
+    "id",
+    "created",
+    "active",
+    "title",
+    "author",
+    "body",
+    "link",
+    "time",
+    "tags",
+    "tts",
+    "ttl",
+    "ttd",
+    "action",
+)
+_SLOT_FIELDS = frozenset(ITEM_FIELDS)
+_INDEX_FIELDS = frozenset(INDEX_FIELDS)
+
+# Item fields that are copied to the channel index.
+CHANNEL_FIELDS = ("id", "active", "created", "tts", "time")
+
+# Fields that can be large. Items built from index entries only keep these once
+# they are accessed, and some storages keep them apart from the other fields.
+PAYLOAD_FIELDS = frozenset(("body",))
+
+# How much of an item built from an index entry has been read from storage
+_LOADED_INDEX = 0
+_LOADED_FIELDS = 1
+_LOADED_ALL = 2
 
 
 class Item:
     """
-    A wrapper for an item object.
+    A wrapper for an item object. Fields are accessed like a dict.
+
+    Items built from index entries start with only the indexed fields. The
+    other fields are read from storage when they are first accessed, and the
+    body is only read once it is accessed itself.
     """
 
+    __slots__ = ("source", *ITEM_FIELDS, "_extra", "_loaded")
+
     def __init__(self, source: "LocalSource", item: dict):
         self.source = source
-        self._item = item
+        self._extra = None
+        self._loaded = _LOADED_ALL
+        for key, value in item.items():
+            self._set(key, value)
+
+    @classmethod
+    def from_entry(cls, source: "LocalSource", entry: dict) -> "Item":
+        """
+        Build an item from its index entry.
+        """
+        item = cls(source, entry)
+        item._loaded = _LOADED_INDEX
+        return item
+
+    @classmethod
+    def from_fields(cls, source: "LocalSource", fields: dict) -> "Item":
+        """
+        Build an item from all of its fields except the body.
+        """
+        item = cls(source, fields)
+        item._loaded = _LOADED_FIELDS
+        return item
+
+    def _set(self, key, value) -> None:
+        if key in _SLOT_FIELDS:
+            setattr(self, key, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def _require(self, key) -> None:
+        """
+        Read the part of the item that a field belongs to from storage, if it
+        has not been read yet.
+        """
+        if key not in _INDEX_FIELDS:
+            self._load(_LOADED_ALL if key in PAYLOAD_FIELDS else _LOADED_FIELDS)
+
+    def _load(self, level: int) -> None:
+        if self._loaded >= level:
+            return
+        body = level == _LOADED_ALL
+        for field, value in self.source.load_item_fields(self.id, body).items():
+            # Fields that were already read or set are not overwritten. This
+            # includes the indexed fields, which are always present.
+            if field in _INDEX_FIELDS:
+                continue
+            if field in PAYLOAD_FIELDS:
+                if body and not hasattr(self, field):
+                    self._set(field, value)
+            elif self._loaded == _LOADED_INDEX:
+                self._set(field, value)
+        self._loaded = level
+
+    @property
+    def body_loaded(self) -> bool:
+        """
+        Whether the item's body has been read from storage or set.
+        """
+        return self._loaded == _LOADED_ALL or hasattr(self, "body")
 
     # Methods to allow Item as a drop-in replacement for the item dict itself
     def __contains__(self, key):
-        return self._item.__contains__(key)
+        self._require(key)
+        if key in _SLOT_FIELDS:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
 
     def __iter__(self):
-        return self._item.__iter__
+        return iter(self.to_dict())
 
     def __getitem__(self, key):
-        return self._item.__getitem__(key)
+        self._require(key)
+        if key in _SLOT_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
 
     def __setitem__(self, key, value):
-        return self._item.__setitem__(key, value)
+        # A new body can be set without reading the old one
+        if key not in PAYLOAD_FIELDS:
+            self._require(key)
+        self._set(key, value)
 
     def get(self, key, default=None):
-        return self._item.get(key, default)
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self, body: bool = True) -> dict:
+        """
+        Get the item's fields as a dict, optionally without the body.
+        """
+        if body and not hasattr(self, "body"):
+            self._load(_LOADED_ALL)
+        else:
+            self._load(_LOADED_FIELDS)
+        item = {}
+        for field in ITEM_FIELDS:
+            if hasattr(self, field) and (body or field != "body"):
+                item[field] = getattr(self, field)
+        if self._extra:
+            item.update(self._extra)
+        return item
 
     @staticmethod
     def create(source: "LocalSource", **fields) -> "Item":
@@ -64,52 +231,49 @@ class Item:
 
     @property
     def display_title(self):
-        return self._item.get("title", self._item["id"])
+        return self.get("title", self.id)
 
     @property
     def can_remove(self):
         # The time-to-live fields protects an item from removal until expiry.
         # This is mainly used to avoid old items resurfacing when their source
         # cannot guarantee monotonocity.
-        if "ttl" in self._item:
-            ttl_date = self._item["created"] + self._item["ttl"]
+        if hasattr(self, "ttl"):
+            ttl_date = self.created + self.ttl
             if ttl_date > current_time():
                 return False
 
         # The time-to-die field puts a maximum lifespan on an item, removing it
         # even if it is active.
-        if "ttd" in self._item:
-            ttd_date = self._item["created"] + self._item["ttd"]
+        if hasattr(self, "ttd"):
+            ttd_date = self.created + self.ttd
             if ttd_date < current_time():
                 return True
 
-        return not self._item["active"]
+        return not self.active
 
     @property
     def before_tts(self):
-        return (
-            "tts" in self._item
-            and current_time() < self._item["created"] + self._item["tts"]
-        )
+        return hasattr(self, "tts") and current_time() < self.created + self.tts
 
     @property
     def is_hidden(self):
-        return not self._item["active"] or self.before_tts
+        return not self.active or self.before_tts
 
     @property
     def sort_key(self):
-        item_date = self._item.get(
-            "time",
-            self._item.get(
-                "created",
-            ),
-        )
-        return (item_date, self._item["id"])
+        item_date = getattr(self, "time", getattr(self, "created", None))
+        return (item_date, self.id)
 
     def serialize(self, indent=True):
-        return json.dumps(self._item, indent=2 if indent else None)
-
-    def update_from(self, updated: "Item") -> None:
+        return json.dumps(self.to_dict(), indent=2 if indent else None)
+
+    def update_from(self, updated: "Item") -> bool:
+        """
+        Update this item's fields from a newer version of it. Returns whether
+        any field changed.
+        """
+        changed = False
         for field in (
             "title",
             "author",
@@ -121,10 +285,19 @@ class Item:
             "ttl",
             "ttd",
         ):
-            if field in updated and self[field] != updated[field]:
+            if field not in updated:
+                continue
+            if field == "body" and not self.body_loaded:
+                # Let the storage compare the body without reading it if it can
+                differs = self.source.storage.body_changed(self.id, updated[field])
+            else:
+                differs = self.get(field) != updated[field]
+            if differs:
                 self[field] = updated[field]
+                changed = True
         # Actions are not updated since the available actions and associated
         # content is left to the action executor to manage.
+        return changed
 
 
 class LocalSource:
@@ -132,16 +305,56 @@ class LocalSource:
     An intake source backed by a filesystem directory.
     """
 
-    def __init__(self, data_path: Path, source_name: str):
+    def __init__(
+        self,
+        data_path: Path,
+        source_name: str,
+        item_cache: ItemCache = None,
+        config_cache: ConfigCache = None,
+    ):
         self.data_path: Path = data_path
         self.source_name = source_name
         self.source_path: Path = data_path / source_name
+        self.item_cache = item_cache
+        self.config_cache = config_cache
+        self._storage = None
+        self._index: ItemIndex = None
+        self._channel_index: ChannelIndex = None
+        self._batch_depth = 0
+        # The channel index rows of the items written in the current batch, or
+        # None for removed items, and whether all of the source's rows need to
+        # be copied again
+        self._channel_changes: Dict[str, Optional[dict]] = {}
+        self._channel_resync = False
 
     def __str__(self) -> str:
         return self.source_name
 
+    def close(self) -> None:
+        """
+        Close the source's index connections. They are opened again if the
+        source is used afterwards.
+        """
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+            # A storage may share the index's connection
+            self._storage = None
+        if self._channel_index is not None:
+            self._channel_index.close()
+            self._channel_index = None
+
     def get_config(self) -> dict:
+        """
+        Get the source config. If the source has a config cache, the config
+        is shared and must not be modified.
+        """
         config_path = self.source_path / "intake.json"
+        if self.config_cache is not None:
+            config = self.config_cache.read_json(config_path)
+            if config is None:
+                raise FileNotFoundError(f"No config for source {self.source_name}")
+            return config
         with open(config_path, "r", encoding="utf8") as config_file:
             return json.load(config_file)
 
@@ -151,79 +364,338 @@ class LocalSource:
         with tmp_path.open("w") as f:
             f.write(json.dumps(config, indent=2))
         os.rename(tmp_path, config_path)
+        if self.config_cache is not None:
+            self.config_cache.invalidate(config_path)
 
     def get_state_path(self) -> Path:
         return (self.source_path / "state").absolute()
 
+    def get_fetch_cursor(self) -> Optional[str]:
+        """
+        Get the cursor reported by the last completed fetch, if any.
+        """
+        try:
+            return (self.source_path / "cursor").read_text(encoding="utf8")
+        except FileNotFoundError:
+            return None
+
+    def save_fetch_cursor(self, cursor: Optional[str]) -> None:
+        cursor_path = self.source_path / "cursor"
+        if cursor is None:
+            cursor_path.unlink(missing_ok=True)
+            return
+        tmp_path = cursor_path.with_name(f"{cursor_path.name}.tmp")
+        tmp_path.write_text(cursor, encoding="utf8")
+        os.rename(tmp_path, cursor_path)
+
+    @property
+    def storage(self) -> ItemStorage:
+        """
+        The item storage for this source, as configured by "storage" in the
+        source config.
+        """
+        if self._storage is None:
+            storage_name = self.get_config().get("storage", FileStorage.name)
+            self._storage = open_storage(self.source_path, storage_name)
+        return self._storage
+
     def get_item_path(self, item_id: dict) -> Path:
         return self.source_path / f"{item_id}.item"
 
     def get_item_ids(self) -> List[str]:
-        return [
-            filepath.name[:-5]
-            for filepath in self.source_path.iterdir()
-            if filepath.name.endswith(".item")
-        ]
+        return self.storage.ids()
 
     def item_exists(self, item_id) -> bool:
-        return self.get_item_path(item_id).exists()
-
-    def get_item(self, item_id: str) -> Item:
-        with self.get_item_path(item_id).open() as f:
-            return Item(self, json.load(f))
+        return self.storage.exists(item_id)
+
+    def get_item(self, item_id: str, body: bool = True) -> Item:
+        """
+        Get an item. If body is False and the storage keeps bodies apart from
+        the other fields, the body is only read if it is accessed.
+        """
+        if not body and self.storage.separate_bodies:
+            return Item.from_fields(self, self.load_item_fields(item_id, body))
+        return Item(self, self.load_item_fields(item_id))
+
+    def load_item_fields(self, item_id: str, body: bool = True) -> dict:
+        """
+        Read an item's fields from storage or the item cache. If body is False,
+        the body may be left out. The returned dict may be shared with the
+        cache and must not be modified.
+        """
+        if not body and self.storage.separate_bodies:
+            ITEM_READS.inc(storage=self.storage.name)
+            return self.storage.load_fields(item_id)
+
+        if self.item_cache is None:
+            ITEM_READS.inc(storage=self.storage.name)
+            return self.storage.load(item_id)
+
+        # Only use a cached item if it has not been rewritten since
+        stamp, size = self.storage.stamp(item_id)
+        key = (self.source_path, item_id)
+        item = self.item_cache.get(key, stamp)
+        if item is None:
+            ITEM_READS.inc(storage=self.storage.name)
+            item = self.storage.load(item_id)
+            self.item_cache.put(key, stamp, item, size)
+        else:
+            ITEM_CACHE_HITS.inc()
+        return item
 
     def save_item(self, item: Item) -> None:
-        # Write to a tempfile first to avoid losing the item on write failure
-        item_path = self.get_item_path(item["id"])
-        tmp_path = item_path.with_name(f"{item_path.name}.tmp")
-        with tmp_path.open("w") as f:
-            f.write(item.serialize())
-        os.rename(tmp_path, item_path)
+        with self.batch():
+            if item.body_loaded:
+                self.storage.save(item.to_dict())
+            else:
+                self.storage.save_fields(item.to_dict(body=False))
+            self.index.put(item)
+            self._channel_changes[item["id"]] = {
+                field: item.get(field) for field in CHANNEL_FIELDS
+            }
+        ITEM_WRITES.inc(storage=self.storage.name)
+        if self.item_cache is not None:
+            self.item_cache.discard((self.source_path, item["id"]))
 
     def delete_item(self, item_id) -> None:
-        os.remove(self.get_item_path(item_id))
+        with self.batch():
+            self.storage.delete(item_id)
+            self.index.remove(item_id)
+            self._channel_changes[item_id] = None
+        ITEM_DELETES.inc(storage=self.storage.name)
+        if self.item_cache is not None:
+            self.item_cache.discard((self.source_path, item_id))
+
+    def deactivate_items(self, item_ids: Iterable[str]) -> int:
+        """
+        Deactivate items in a single batch. Returns the number of items that
+        were deactivated. Items that do not exist are skipped.
+        """
+        count = 0
+        with self.batch():
+            for item_id in item_ids:
+                try:
+                    item = self.get_item(item_id, body=False)
+                except FileNotFoundError:
+                    continue
+                if item["active"]:
+                    item["active"] = False
+                    self.save_item(item)
+                    count += 1
+        return count
 
     def get_all_items(self) -> List[Item]:
-        for filepath in self.source_path.iterdir():
-            if filepath.name.endswith(".item"):
-                yield Item(self, json.loads(filepath.read_text(encoding="utf8")))
+        count = 0
+        try:
+            for item in self.storage.load_all():
+                count += 1
+                yield Item(self, item)
+        finally:
+            ITEM_READS.inc(count, storage=self.storage.name)
+
+    def convert_storage(self, storage_name: str) -> int:
+        """
+        Move this source's items to a different storage. Returns the number of
+        items moved.
+        """
+        old_storage = self.storage
+        new_storage = open_storage(self.source_path, storage_name)
+        if new_storage.name == old_storage.name:
+            return 0
+        count = 0
+        items = old_storage.load_all()
+        while chunk := list(islice(items, UPDATE_CHUNK_SIZE)):
+            with new_storage.batch():
+                for item in chunk:
+                    new_storage.save(item)
+            count += len(chunk)
+        # Only remove the old items once the config points at the new ones
+        self.save_config({**self.get_config(), "storage": new_storage.name})
+        self._storage = new_storage
+        old_storage.destroy()
+        # The new storage may keep its index differently, so reopen it
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        self.rebuild_index()
+        if self.item_cache is not None:
+            self.item_cache.clear()
+        return count
+
+    def compact(self, force: bool = False) -> bool:
+        """
+        Remove dead records from the item storage, if it has any.
+        """
+        return self.storage.compact(force)
 
+    @property
+    def index(self) -> ItemIndex:
+        """
+        The item metadata index for this source. If the index does not exist
+        yet, it is built from the stored items.
+        """
+        if self._index is None:
+            index = self.storage.open_index()
+            if not index.exists:
+                with index.batch():
+                    for item in self.get_all_items():
+                        index.put(item)
+            self._index = index
+        return self._index
+
+    def rebuild_index(self) -> None:
+        """
+        Rebuild the item index from the stored items.
+        """
+        with self.batch():
+            self.index.clear()
+            for item in self.get_all_items():
+                self.index.put(item)
+            self._channel_resync = True
 
-def _read_stdout(process: Popen, output: list) -> None:
+    @property
+    def channel_index(self) -> ChannelIndex:
+        """
+        The data directory's channel index, which has the active items of
+        every source.
+        """
+        if self._channel_index is None:
+            self._channel_index = ChannelIndex(self.data_path)
+        return self._channel_index
+
+    @contextmanager
+    def batch(self):
+        """
+        Group item writes into a transaction on the source index. The changes
+        to the channel index, which is shared by all sources, are collected
+        and written in a short transaction at the end of the batch, along with
+        the generation of the source index they match. This is still within
+        the source index transaction, so writers to the same source are
+        serialized, but writers to other sources only wait for each other
+        while the channel index is written.
+        """
+        outermost = self._batch_depth == 0
+        self._batch_depth += 1
+        try:
+            with self.index.batch():
+                start_generation = self.index.generation() if outermost else None
+                try:
+                    yield self
+                finally:
+                    if outermost:
+                        self._write_channel_changes(start_generation)
+        finally:
+            self._batch_depth -= 1
+
+    def _write_channel_changes(self, start_generation: Tuple[int, int]) -> None:
+        changes, self._channel_changes = self._channel_changes, {}
+        resync, self._channel_resync = self._channel_resync, False
+        channel_index = self.channel_index
+        synced = channel_index.synced_generation(self.source_name)
+        generation = self.index.pending_generation()
+        if not resync and synced == start_generation:
+            if not changes and synced == generation:
+                return
+            with channel_index.batch():
+                for item_id, row in changes.items():
+                    if row is None:
+                        channel_index.remove(self.source_name, item_id)
+                    else:
+                        channel_index.put(self.source_name, row)
+                channel_index.set_synced(self.source_name, generation)
+        else:
+            # Catch up on changes the channel index missed, reading the index
+            # as it is in this batch
+            with channel_index.batch():
+                channel_index.copy_source(self.source_name, self.index)
+                channel_index.set_synced(self.source_name, generation)
+
+    def get_indexed_items(self) -> List[Item]:
+        """
+        Get all items with only their indexed fields. These items can be used
+        to filter and sort items without loading them fully. Other fields are
+        read from storage when they are accessed.
+        """
+        for entry in self.index.entries():
+            yield Item.from_entry(self, entry)
+
+    def get_sorted_items(self, show_hidden: bool) -> List[Item]:
+        """
+        Get items with only their indexed fields in feed order, optionally
+        skipping hidden items.
+        """
+        visible_at = None if show_hidden else current_time()
+        for entry in self.index.sorted_entries(visible_at):
+            yield Item.from_entry(self, entry)
+
+    def get_active_items(
+        self,
+        visible_only: bool = False,
+        created_before: int = None,
+        time_before: int = None,
+    ) -> List[Item]:
+        """
+        Get the active items with only their indexed fields, optionally only
+        those that are visible or older than a cutoff.
+        """
+        visible_at = current_time() if visible_only else None
+        entries = self.index.active_entries(visible_at, created_before, time_before)
+        for entry in entries:
+            yield Item.from_entry(self, entry)
+
+    def count_items(self, show_hidden: bool) -> int:
+        """
+        Count the items in this source, optionally skipping hidden items.
+        """
+        return self.index.count(None if show_hidden else current_time())
+
+
+async def _read_stderr(stream: asyncio.StreamReader) -> None:
     """
-    Read the subprocess's stdout into memory.
+    Read the subprocess's stderr stream and pass it to logging.
     This prevents the process from blocking when the pipe fills up.
     """
     while True:
-        data = process.stdout.readline()
-        if data:
-            print(f"[stdout] {data.rstrip()}", file=sys.stderr)
-            output.append(data)
-        if process.poll() is not None:
+        try:
+            data = await stream.readline()
+        except ValueError:
+            # The line was too long and has been discarded
+            print("[stderr] (line too long)", file=sys.stderr)
+            continue
+        if not data:
             break
+        print(f"[stderr] {data.decode('utf8').rstrip()}", file=sys.stderr)
 
 
-def _read_stderr(process: Popen) -> None:
+async def _process_exited(process: asyncio.subprocess.Process) -> None:
     """
-    Read the subprocess's stderr stream and pass it to logging.
-    This prevents the process from blocking when the pipe fills up.
+    Wait for a process to exit. Unlike process.wait(), this does not also wait
+    for the process's pipes to be closed by any children it started.
     """
-    while True:
-        data = process.stderr.readline()
-        if data:
-            print(f"[stderr] {data.rstrip()}", file=sys.stderr)
-        if process.poll() is not None:
-            break
+    while process.returncode is None:
+        await asyncio.sleep(STOP_POLL_SECONDS)
 
 
-def _execute_source_action(
-    source: LocalSource, action: str, input: str, timeout: timedelta
-) -> List[str]:
+async def _stop_process_group(process: asyncio.subprocess.Process) -> None:
     """
-    Execute the action from a given source. If stdin is specified, pass it
-    along to the process. Returns lines from stdout.
+    Stop a process and any children it started that are still running, first
+    with SIGTERM and then with SIGKILL if they have not all exited after a
+    grace period. The process's pipes are not closed until every process
+    holding them has exited.
+    """
+    if signal_process_group(process.pid, signal.SIGTERM):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + KILL_GRACE_SECONDS
+        while loop.time() < deadline and process_group_running(process.pid):
+            await asyncio.sleep(STOP_POLL_SECONDS)
+        signal_process_group(process.pid, signal.SIGKILL)
+    await process.wait()
+
+
+def _action_command(source: LocalSource, action: str) -> Tuple[dict, List[str], dict]:
+    """
+    Get the config, command line, and environment of a source action.
     """
-    # Gather the information necessary to launch the process
     config = source.get_config()
     action_cfg = config.get("action", {}).get(action)
 
@@ -239,81 +711,375 @@ def _execute_source_action(
         **config_env,
         "STATE_PATH": str(source.get_state_path()),
     }
+    return action_cfg, command, env
+
+
+def _action_timeout(action_cfg: dict, default: float) -> float:
+    """
+    Get the number of seconds an action may run, from its config if set.
+    """
+    timeout = action_cfg.get("timeout", default)
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)):
+        raise InvalidConfigException("timeout must be a number of seconds")
+    if timeout <= 0:
+        raise InvalidConfigException("timeout must be positive")
+    return timeout
+
+
+def _action_int(action_cfg: dict, key: str, default: int = None) -> Optional[int]:
+    """
+    Get an optional positive integer setting of an action from its config.
+    """
+    value = action_cfg.get(key, default)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+        raise InvalidConfigException(f"{key} must be a positive integer")
+    return value
+
+
+def _action_limits(action_cfg: dict) -> Limits:
+    """
+    Get the resource limits of an action from its config.
+    """
+    limits = []
+    for key, which in (
+        ("cpu_limit", resource.RLIMIT_CPU),
+        ("memory_limit", resource.RLIMIT_AS),
+    ):
+        value = _action_int(action_cfg, key)
+        if value is None:
+            continue
+        # A process that uses up its CPU time gets SIGXCPU at the soft limit,
+        # which it may handle to exit cleanly, and is killed a second later
+        hard = value + 1 if which == resource.RLIMIT_CPU else value
+        limits.append((which, (value, hard)))
+    return tuple(limits)
+
+
+async def _stream_source_action(
+    source: LocalSource,
+    action: str,
+    input: str,
+    timeout: float,
+    extra_env: Dict[str, str] = None,
+) -> AsyncIterator[str]:
+    """
+    Execute the action from a given source. If stdin is specified, pass it
+    along to the process. Yields lines from stdout as they are read.
+    """
+    # Gather the information necessary to launch the process
+    action_cfg, command, env = _action_command(source, action)
+    env.update(extra_env or {})
+    timeout = _action_timeout(action_cfg, timeout)
+    limits = _action_limits(action_cfg)
+    max_line_bytes = _action_int(action_cfg, "max_line_bytes", STREAM_LIMIT)
+    max_output_bytes = _action_int(action_cfg, "max_output_bytes")
 
     # Launch the process
+    start = perf_counter()
     try:
-        process = Popen(
-            command,
+        process = await asyncio.create_subprocess_exec(
+            *command,
             stdin=PIPE,
             stdout=PIPE,
             stderr=PIPE,
             cwd=source.source_path,
             env=env,
-            encoding="utf8",
+            limit=max_line_bytes,
+            # Start a new process group so the action's children can be killed
+            start_new_session=True,
         )
     except PermissionError:
         raise SourceUpdateException(f"Command not executable: {''.join(command)}")
-
-    # Kick off monitoring threads
-    output = []
-    t_stdout: Thread = Thread(target=_read_stdout, args=(process, output), daemon=True)
-    t_stdout.start()
-    t_stderr: Thread = Thread(target=_read_stderr, args=(process,), daemon=True)
-    t_stderr.start()
+    apply_limits(process.pid, limits)
 
     # Send input to the process, if provided
     if input:
-        process.stdin.write(input)
         if not input.endswith("\n"):
-            process.stdin.write("\n")
-        process.stdin.flush()
+            input += "\n"
+        process.stdin.write(input.encode("utf8"))
+    process.stdin.close()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    stderr_task = asyncio.ensure_future(_read_stderr(process.stderr))
+    wait_task = asyncio.ensure_future(_process_exited(process))
+    read_task = None
+    group_stopped = False
+    output_bytes = 0
+    try:
+        while True:
+            read_task = asyncio.ensure_future(process.stdout.readline())
+            if not wait_task.done():
+                await asyncio.wait(
+                    (read_task, wait_task),
+                    timeout=deadline - loop.time(),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not wait_task.done() and not read_task.done():
+                    raise asyncio.TimeoutError()
+            if wait_task.done() and not group_stopped:
+                # Once the process exits, stop any children it left running,
+                # which may still be holding stdout open, and drain the output
+                await _stop_process_group(process)
+                group_stopped = True
+            try:
+                data = await asyncio.wait_for(read_task, deadline - loop.time())
+            except ValueError:
+                raise SourceUpdateException(
+                    f"{source.source_name} {action} output a line longer than"
+                    f" {max_line_bytes} bytes"
+                )
+            if not data:
+                break
+            output_bytes += len(data)
+            if max_output_bytes is not None and output_bytes > max_output_bytes:
+                raise SourceUpdateException(
+                    f"{source.source_name} {action} output more than"
+                    f" {max_output_bytes} bytes"
+                )
+            line = data.decode("utf8")
+            print(f"[stdout] {line.rstrip()}", file=sys.stderr)
+            yield line
+
+        await asyncio.wait_for(wait_task, deadline - loop.time())
+        if not group_stopped:
+            # Children left running may also be holding stderr open
+            await _stop_process_group(process)
+        await asyncio.wait_for(stderr_task, deadline - loop.time())
+    except asyncio.TimeoutError:
+        raise SourceUpdateException(f"{source.source_name} {action} timed out")
+    finally:
+        # Don't leave the process or its children running if it timed out,
+        # failed, or the caller stopped reading early
+        await _stop_process_group(process)
+        pending = [task for task in (stderr_task, wait_task, read_task) if task]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        labels = {"source": source.source_name, "action": action}
+        ACTION_DURATION.observe(perf_counter() - start, **labels)
+        ACTION_OUTPUT_BYTES.inc(output_bytes, **labels)
+
+    if process.returncode == -signal.SIGXCPU:
+        raise SourceUpdateException(
+            f"{source.source_name} {action} exceeded its CPU limit"
+        )
+    if process.returncode:
+        raise SourceUpdateException(
+            f"{source.source_name} {action} failed with code {process.returncode}"
+        )
+
 
+async def _execute_source_action_async(
+    source: LocalSource, action: str, input: str, timeout: float
+) -> List[str]:
+    """
+    Execute the action from a given source. If stdin is specified, pass it
+    along to the process. Returns lines from stdout.
+    """
+    stream = _stream_source_action(source, action, input, timeout)
     try:
-        process.wait(timeout=timeout.total_seconds())
-    except TimeoutExpired:
-        process.kill()
-    t_stdout.join(timeout=1)
-    t_stderr.join(timeout=1)
+        return [line async for line in stream]
+    finally:
+        await stream.aclose()
+
+
+def _execute_source_action(
+    source: LocalSource, action: str, input: str, timeout: float
+) -> List[str]:
+    """
+    Synchronous wrapper for _execute_source_action_async.
+    """
+    return asyncio.run(_execute_source_action_async(source, action, input, timeout))
+
 
-    if process.poll():
+def _iter_async(agen: AsyncIterator) -> Iterator:
+    """
+    Iterate an async generator from synchronous code by running it on a
+    private event loop one item at a time.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+class FetchStatus:
+    """
+    What a fetch reported about the feed besides its items. A fetch may output
+    lines without an id to report a cursor, which is passed to the next fetch
+    in LAST_FETCH, that the feed has not been modified since that cursor, or
+    that the fetch is a delta that only includes the items that changed. A
+    delta may delete items with {"id": ..., "deleted": true} lines.
+    """
+
+    def __init__(self):
+        self.cursor: Optional[str] = None
+        self.not_modified = False
+        self.delta = False
+        self.deleted_ids: Set[str] = set()
+
+    def read_line(self, fields: dict) -> None:
+        """
+        Read a fetch output line that is not an item.
+        """
+        if not fields or not set(fields) <= {"cursor", "not_modified", "delta"}:
+            raise SourceUpdateException("fetch output an item without an id")
+        if "cursor" in fields:
+            if not isinstance(fields["cursor"], str):
+                raise SourceUpdateException("fetch cursor must be a string")
+            self.cursor = fields["cursor"]
+        if fields.get("not_modified"):
+            self.not_modified = True
+        if fields.get("delta"):
+            self.delta = True
+
+
+async def iter_fetch_items_async(
+    source: LocalSource, timeout: int = 60, status: FetchStatus = None
+) -> AsyncIterator[Item]:
+    """
+    Execute the feed source and yield feed items as they are read. If status
+    is given, the fetch is passed the saved cursor, and the lines of the fetch
+    that are not items, including deleted items, are recorded in the status.
+    Otherwise, the fetch must return the full feed. Throws
+    SourceUpdateException if the feed source update failed.
+    """
+    fetch_cfg = source.get_config().get("action", {}).get("fetch", {})
+    max_items = _action_int(fetch_cfg, "max_items")
+
+    # Only a caller that gets the status can tell a partial fetch from a full
+    # one, so a fetch without a status is not given the cursor
+    extra_env = {}
+    full_only = status is None
+    if full_only:
+        status = FetchStatus()
+    elif (cursor := source.get_fetch_cursor()) is not None:
+        extra_env["LAST_FETCH"] = cursor
+
+    count = 0
+    stream = _stream_source_action(source, "fetch", None, timeout, extra_env)
+    try:
+        async for line in stream:
+            try:
+                fields = json.loads(line)
+            except json.JSONDecodeError:
+                raise SourceUpdateException("invalid json")
+            if "id" not in fields:
+                if fields.get("delta") and count:
+                    raise SourceUpdateException(
+                        f"{source.source_name} fetch reported delta after items"
+                    )
+                status.read_line(fields)
+                continue
+            if fields.get("deleted"):
+                status.deleted_ids.add(fields["id"])
+                continue
+            item = Item.create(source, **fields)
+            count += 1
+            if max_items is not None and count > max_items:
+                raise SourceUpdateException(
+                    f"{source.source_name} fetch returned more than {max_items} items"
+                )
+            yield item
+    finally:
+        # Stop the process as soon as reading stops
+        await stream.aclose()
+        FETCH_ITEMS.inc(count, source=source.source_name)
+    if full_only and (status.not_modified or status.delta):
         raise SourceUpdateException(
-            f"{source.source_name} {action} failed with code {process.returncode}"
+            f"{source.source_name} fetch did not return the full feed"
+        )
+    if status.not_modified and (count or status.deleted_ids):
+        raise SourceUpdateException(
+            f"{source.source_name} fetch returned items but reported not modified"
         )
 
-    return output
 
+def iter_fetch_items(
+    source: LocalSource, timeout: int = 60, status: FetchStatus = None
+) -> Iterator[Item]:
+    """
+    Synchronous wrapper for iter_fetch_items_async.
+    """
+    return _iter_async(iter_fetch_items_async(source, timeout, status))
 
-def fetch_items(source: LocalSource, timeout: int = 60) -> List[Item]:
+
+async def fetch_items_async(source: LocalSource, timeout: int = 60) -> List[Item]:
     """
     Execute the feed source and return the current feed items.
     Returns a list of feed items on success.
     Throws SourceUpdateException if the feed source update failed.
     """
-    items: List[Item] = []
+    return [item async for item in iter_fetch_items_async(source, timeout)]
 
-    output = _execute_source_action(source, "fetch", None, timedelta(timeout))
 
-    for line in output:
-        try:
-            item = Item.create(source, **json.loads(line))
-            items.append(item)
-        except json.JSONDecodeError:
-            raise SourceUpdateException("invalid json")
+def fetch_items(source: LocalSource, timeout: int = 60) -> List[Item]:
+    """
+    Synchronous wrapper for fetch_items_async.
+    """
+    return list(iter_fetch_items(source, timeout))
 
-    return items
+
+def _request_action_worker(
+    source: LocalSource, action: str, input: str, timeout: float
+) -> Optional[List[str]]:
+    """
+    Send an item to the persistent worker for a source action and return its
+    response line. Returns None if no worker is available, in which case the
+    action should be run in its own process instead.
+    """
+    action_cfg, command, env = _action_command(source, action)
+    start = perf_counter()
+    try:
+        line = WORKERS.request(
+            (str(source.source_path), action),
+            command,
+            env,
+            source.source_path,
+            _action_limits(action_cfg),
+            input,
+            _action_timeout(action_cfg, timeout),
+            _action_int(action_cfg, "max_line_bytes", STREAM_LIMIT),
+        )
+    except PermissionError:
+        raise SourceUpdateException(f"Command not executable: {''.join(command)}")
+    except SourceUpdateException as ex:
+        raise SourceUpdateException(f"{source.source_name} {action} {ex}")
+    finally:
+        labels = {"source": source.source_name, "action": action}
+        ACTION_DURATION.observe(perf_counter() - start, **labels)
+    if line is None:
+        return None
+    ACTION_OUTPUT_BYTES.inc(len(line.encode("utf8")), **labels)
+    print(f"[stdout] {line.rstrip()}", file=sys.stderr)
+    return [line]
 
 
 def execute_action(
-    source: LocalSource, item_id: str, action: str, timeout: int = 60
+    source: LocalSource, item_id: str, action: str, timeout: float = 60
 ) -> dict:
     """
     Execute the action for a feed source.
     """
     item: Item = source.get_item(item_id)
-
-    output = _execute_source_action(
-        source, action, item.serialize(indent=False), timedelta(timeout)
-    )
+    input = item.serialize(indent=False)
+
+    output = None
+    action_cfg = source.get_config().get("action", {}).get(action, {})
+    if action_cfg.get("persistent"):
+        output = _request_action_worker(source, action, input, timeout)
+    if output is None:
+        output = _execute_source_action(source, action, input, timeout)
     if not output:
         raise SourceUpdateException("no item")
 
@@ -325,45 +1091,210 @@ def execute_action(
         raise SourceUpdateException("invalid json")
 
 
-def update_items(source: LocalSource, fetched_items: List[Item]):
+class ItemUpdate:
     """
-    Update the source with a batch of new items, doing creations, updates, and
-    deletions as necessary.
-    """
-    # Get a list of item ids that already existed for this source.
-    prior_ids = source.get_item_ids()
-    print(f"Found {len(prior_ids)} prior items", file=sys.stderr)
-
-    # Determine which items are new and which are updates.
-    new_items: List[Item] = []
-    upd_items: List[Item] = []
-    for item in fetched_items:
-        if source.item_exists(item["id"]):
-            upd_items.append(item)
+    An in-progress update of a source with fetched items. Fetched items are
+    written as they are added, but nothing is deleted until the update is
+    finished, so a fetch that fails partway through does not remove items.
+
+    If the fetch status reports a delta, only the items that were added or
+    deleted are looked up, and items the fetch did not mention are left alone.
+    """
+
+    def __init__(self, source: LocalSource, status: FetchStatus = None):
+        self.source = source
+        self.status = status
+        self.timings: Dict[str, float] = {"scan": 0.0, "new": 0.0, "update": 0.0}
+        # Scanned when the first items are added, so that an update of a feed
+        # that was not modified does not scan the source
+        self._prior_ids: Optional[Set[str]] = None
+        self.new_ids: Set[str] = set()
+        self.upd_ids: Set[str] = set()
+        self.changed_ids: Set[str] = set()
+
+    @property
+    def prior_ids(self) -> Set[str]:
+        """
+        The ids of the items that already existed for this source.
+        """
+        if self._prior_ids is None:
+            # Get the ids with a single directory scan
+            start = perf_counter()
+            self._prior_ids = set(self.source.get_item_ids())
+            self.timings["scan"] = perf_counter() - start
+            print(f"Found {len(self._prior_ids)} prior items", file=sys.stderr)
+        return self._prior_ids
+
+    @property
+    def delta(self) -> bool:
+        return self.status is not None and self.status.delta
+
+    def _existed(self, item_id: str) -> bool:
+        if self.delta:
+            return item_id not in self.new_ids and self.source.item_exists(item_id)
+        return item_id in self.prior_ids
+
+    def add(self, fetched_items: List[Item]) -> None:
+        """
+        Write new items to the source directory and update the existing items
+        using the fetched items' values.
+        """
+        with self.source.batch():
+            for item in fetched_items:
+                item_id = item["id"]
+                start = perf_counter()
+                if self._existed(item_id):
+                    # Only rewrite the item if something changed
+                    old_item = self.source.get_item(item_id, body=False)
+                    if old_item.update_from(item):
+                        self.source.save_item(old_item)
+                        self.changed_ids.add(item_id)
+                    self.upd_ids.add(item_id)
+                    self.timings["update"] += perf_counter() - start
+                else:
+                    # TODO: support on-create trigger
+                    self.source.save_item(item)
+                    self.new_ids.add(item_id)
+                    self.timings["new"] += perf_counter() - start
+
+    def finish(self) -> None:
+        """
+        Remove items that are no longer needed.
+        """
+        # Items are removed when they are old (not in the latest fetch) and
+        # inactive. Some item fields change this basic behavior. The indexed
+        # fields are enough to decide this, so the old items are not loaded.
+        start = perf_counter()
+        del_count = 0
+        # now = int(current_time())
+        entries = {}
+        if self.delta:
+            # Deleted items are treated like items left out of a full fetch
+            old_item_ids = {
+                item_id
+                for item_id in self.status.deleted_ids - self.upd_ids
+                if self._existed(item_id)
+            }
         else:
-            new_items.append(item)
+            old_item_ids = self.prior_ids - self.upd_ids
+            if old_item_ids:
+                entries = {entry["id"]: entry for entry in self.source.index.entries()}
+
+        with self.source.batch():
+            # Only items that are still absent from fetches are reaped when
+            # they expire between updates
+            if self.delta:
+                self.source.index.mark_stale(old_item_ids, self.upd_ids)
+            else:
+                self.source.index.set_stale(old_item_ids)
+            for item_id in old_item_ids:
+                if item_id in entries:
+                    old_item = Item.from_entry(self.source, entries[item_id])
+                else:
+                    old_item = self.source.get_item(item_id, body=False)
+                if old_item.can_remove:
+                    self.source.delete_item(item_id)
+                    del_count += 1
+        self.timings["delete"] = perf_counter() - start
+
+        start = perf_counter()
+        if self.source.compact():
+            self.timings["compact"] = perf_counter() - start
+
+        print(
+            len(self.new_ids),
+            "new,",
+            len(self.changed_ids),
+            "changed,",
+            del_count,
+            "deleted",
+            file=sys.stderr,
+        )
+        print(
+            "Timings:",
+            ", ".join(f"{phase} {secs:.3f}s" for phase, secs in self.timings.items()),
+            file=sys.stderr,
+        )
+        for phase, secs in self.timings.items():
+            UPDATE_PHASE_DURATION.observe(secs, phase=phase)
+        UPDATE_ITEMS.inc(len(self.new_ids), result="new")
+        UPDATE_ITEMS.inc(len(self.changed_ids), result="changed")
+        UPDATE_ITEMS.inc(del_count, result="deleted")
 
-    # Write all the new items to the source directory.
-    for item in new_items:
-        # TODO: support on-create trigger
-        source.save_item(item)
 
-    # Update the other items using the fetched items' values.
-    for upd_item in upd_items:
-        old_item = source.get_item(upd_item["id"])
-        old_item.update_from(upd_item)
-        source.save_item(old_item)
-
-    # Items are removed when they are old (not in the latest fetch) and
-    # inactive. Some item fields change this basic behavior.
-    del_count = 0
-    # now = int(current_time())
-    upd_ids = [item["id"] for item in upd_items]
-    old_item_ids = [item_id for item_id in prior_ids if item_id not in upd_ids]
-
-    for item_id in old_item_ids:
-        if source.get_item(item_id).can_remove:
-            source.delete_item(item_id)
-            del_count += 1
-
-    print(len(new_items), "new,", del_count, "deleted", file=sys.stderr)
+def update_items(
+    source: LocalSource, fetched_items: Iterable[Item], status: FetchStatus = None
+):
+    """
+    Update the source with a batch of new items, doing creations, updates, and
+    deletions as necessary. Fetched items are written in chunks as they are
+    iterated, so they can be streamed from iter_fetch_items. If the status of
+    the fetch is given, its cursor is saved for the next fetch, and if the feed
+    was not modified, only expired items are deleted.
+    """
+    update = ItemUpdate(source, status)
+    iterator = iter(fetched_items)
+    while chunk := list(islice(iterator, UPDATE_CHUNK_SIZE)):
+        update.add(chunk)
+    _finish_update(update, status)
+
+
+def _finish_update(update: ItemUpdate, status: Optional[FetchStatus]) -> None:
+    source = update.source
+    if status is None:
+        update.finish()
+        return
+    if status.not_modified:
+        print("Not modified", file=sys.stderr)
+        reap_items(source)
+        if status.cursor is not None:
+            source.save_fetch_cursor(status.cursor)
+        return
+    update.finish()
+    if status.delta:
+        # A delta does not mention the items that expired since they were
+        # deleted from the feed by an earlier fetch
+        reap_items(source)
+    source.save_fetch_cursor(status.cursor)
+
+
+def reap_items(source: LocalSource) -> int:
+    """
+    Delete the items that an update would delete because they were not in the
+    latest fetch and have expired since, without fetching. Returns the number
+    of items deleted.
+    """
+    start = perf_counter()
+    count = 0
+    with source.batch():
+        for entry in source.index.due_removals(current_time()):
+            item = Item.from_entry(source, entry)
+            if item.can_remove:
+                source.delete_item(item["id"])
+                count += 1
+    if count:
+        source.compact()
+    UPDATE_PHASE_DURATION.observe(perf_counter() - start, phase="reap")
+    UPDATE_ITEMS.inc(count, result="reaped")
+    return count
+
+
+async def update_items_async(
+    source: LocalSource,
+    fetched_items: AsyncIterator[Item],
+    status: FetchStatus = None,
+):
+    """
+    Update the source with items from an async iterator, such as
+    iter_fetch_items_async, like update_items. The items are written on the
+    event loop's thread.
+    """
+    update = ItemUpdate(source, status)
+    chunk: List[Item] = []
+    async for item in fetched_items:
+        chunk.append(item)
+        if len(chunk) >= UPDATE_CHUNK_SIZE:
+            update.add(chunk)
+            chunk = []
+    update.add(chunk)
+    _finish_update(update, status)
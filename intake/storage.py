@@ -0,0 +1,499 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+
+from intake.index import ItemIndex, INDEX_FILENAME
+from intake.types import InvalidConfigException
+
+
+SEGMENT_FILENAME = "items.seg"
+
+# Compact a segment when at least this many bytes are superseded or deleted
+# records and they make up at least half of the segment.
+COMPACT_MIN_DEAD_BYTES = 1024 * 1024
+
+
+class ItemStorage(ABC):
+    """
+    Base class for the ways a source's items can be stored. Item semantics do
+    not depend on the storage: saving replaces an item, loading or deleting a
+    missing item raises FileNotFoundError, and items are returned as dicts.
+    """
+
+    # The name of the storage in the source config.
+    name: str = None
+
+    # Whether item bodies are stored apart from the other fields, so that the
+    # other fields can be read and written without reading the body.
+    separate_bodies = False
+
+    def __init__(self, source_path: Path):
+        self.source_path = source_path
+
+    @abstractmethod
+    def ids(self) -> List[str]:
+        """
+        Get the ids of all stored items.
+        """
+
+    @abstractmethod
+    def exists(self, item_id: str) -> bool:
+        pass
+
+    @abstractmethod
+    def stamp(self, item_id: str) -> Tuple[Hashable, int]:
+        """
+        Get a value that changes whenever the item is rewritten, and the size
+        of the stored item.
+        """
+
+    @abstractmethod
+    def load(self, item_id: str) -> dict:
+        pass
+
+    @abstractmethod
+    def save(self, item: dict) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, item_id: str) -> None:
+        pass
+
+    @abstractmethod
+    def load_all(self) -> Iterator[dict]:
+        """
+        Get every stored item. Items are read as they are iterated.
+        """
+
+    @abstractmethod
+    def destroy(self) -> None:
+        """
+        Delete all stored items.
+        """
+
+    def load_fields(self, item_id: str) -> dict:
+        """
+        Load an item without its body.
+        """
+        item = self.load(item_id)
+        item.pop("body", None)
+        return item
+
+    def save_fields(self, item: dict) -> None:
+        """
+        Save an item's fields other than the body, keeping its stored body.
+        """
+        body = self.load(item["id"]).get("body")
+        if body is not None:
+            item = {**item, "body": body}
+        self.save(item)
+
+    def body_changed(self, item_id: str, body: Optional[str]) -> bool:
+        """
+        Check whether an item's stored body differs from a given body.
+        """
+        return self.load(item_id).get("body") != body
+
+    def open_index(self) -> ItemIndex:
+        """
+        Get the item index for this storage.
+        """
+        return ItemIndex(self.source_path / INDEX_FILENAME)
+
+    def batch(self):
+        """
+        Group item writes, if the storage supports it.
+        """
+        return nullcontext()
+
+    def compact(self, force: bool = False) -> bool:
+        """
+        Reclaim space used by replaced and deleted items. Unless forced, this
+        is only done if it is worthwhile. Returns whether anything was done.
+        """
+        return False
+
+
+class FileStorage(ItemStorage):
+    """
+    Items stored as one JSON file per item in the source directory.
+    """
+
+    name = "files"
+
+    def get_item_path(self, item_id: str) -> Path:
+        return self.source_path / f"{item_id}.item"
+
+    def ids(self) -> List[str]:
+        return [
+            filepath.name[:-5]
+            for filepath in self.source_path.iterdir()
+            if filepath.name.endswith(".item")
+        ]
+
+    def exists(self, item_id: str) -> bool:
+        return self.get_item_path(item_id).exists()
+
+    def stamp(self, item_id: str) -> Tuple[Hashable, int]:
+        stat = self.get_item_path(item_id).stat()
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino), stat.st_size
+
+    def load(self, item_id: str) -> dict:
+        with self.get_item_path(item_id).open() as f:
+            return json.load(f)
+
+    def save(self, item: dict) -> None:
+        # Write to a tempfile first to avoid losing the item on write failure
+        item_path = self.get_item_path(item["id"])
+        tmp_path = item_path.with_name(f"{item_path.name}.tmp")
+        with tmp_path.open("w") as f:
+            f.write(json.dumps(item, indent=2))
+        os.rename(tmp_path, item_path)
+
+    def delete(self, item_id: str) -> None:
+        os.remove(self.get_item_path(item_id))
+
+    def load_all(self) -> Iterator[dict]:
+        for filepath in self.source_path.iterdir():
+            if filepath.name.endswith(".item"):
+                yield json.loads(filepath.read_text(encoding="utf8"))
+
+    def destroy(self) -> None:
+        for filepath in self.source_path.iterdir():
+            if filepath.name.endswith(".item"):
+                filepath.unlink()
+
+
+class SegmentStorage(ItemStorage):
+    """
+    Items stored as records in an append-only segment file, with an in-memory
+    index of the location of each item's latest record. Replaced and deleted
+    records remain in the segment until it is compacted.
+
+    Each record is one line. A saved item is `+ <id as JSON>\\t<item JSON>` and
+    a deleted item is `- <id as JSON>\\t`. JSON encoding ensures neither part
+    contains a raw tab or newline.
+    """
+
+    name = "segment"
+
+    def __init__(self, source_path: Path):
+        super().__init__(source_path)
+        self.segment_path = source_path / SEGMENT_FILENAME
+        # Item id to the offset and length of its latest item JSON
+        self._offsets: Dict[str, Tuple[int, int]] = {}
+        self._inode: Optional[int] = None
+        self._scanned = 0
+        self._dead_bytes = 0
+        self._mmap: Optional[mmap.mmap] = None
+
+    @contextmanager
+    def _lock(self):
+        """
+        Lock the source directory against other writers.
+        """
+        fd = os.open(self.source_path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _map(self) -> Optional[mmap.mmap]:
+        """
+        Map the segment file into memory, remapping it if it has changed.
+        """
+        try:
+            stat = self.segment_path.stat()
+        except FileNotFoundError:
+            self._reset(None)
+            return None
+        if stat.st_ino != self._inode:
+            self._reset(stat.st_ino)
+        if self._mmap is None or len(self._mmap) != stat.st_size:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if stat.st_size == 0:
+                return None
+            with self.segment_path.open("rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _reset(self, inode: Optional[int]) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._offsets = {}
+        self._inode = inode
+        self._scanned = 0
+        self._dead_bytes = 0
+
+    def _refresh(self) -> None:
+        """
+        Read any records added to the segment since it was last scanned,
+        including those written by other processes.
+        """
+        data = self._map()
+        if data is None:
+            return
+        pos = self._scanned
+        while True:
+            end = data.find(b"\n", pos)
+            if end == -1:
+                # Stop at an incomplete record that is still being written
+                break
+            tab = data.find(b"\t", pos, end)
+            item_id = json.loads(data[pos + 2 : tab])
+            if item_id in self._offsets:
+                self._dead_bytes += self._offsets[item_id][1]
+            if data[pos : pos + 1] == b"+":
+                self._offsets[item_id] = (tab + 1, end - tab - 1)
+            else:
+                self._offsets.pop(item_id, None)
+                self._dead_bytes += end + 1 - pos
+            pos = end + 1
+        self._scanned = pos
+
+    def _append(self, record: bytes) -> None:
+        with self._lock():
+            self._refresh()
+            # With the lock held, an incomplete record can only be left over
+            # from a writer that failed, so drop it.
+            data = self._map()
+            if data is not None and self._scanned < len(data):
+                os.truncate(self.segment_path, self._scanned)
+            with self.segment_path.open("ab") as f:
+                f.write(record)
+            self._refresh()
+
+    def ids(self) -> List[str]:
+        self._refresh()
+        return list(self._offsets)
+
+    def exists(self, item_id: str) -> bool:
+        self._refresh()
+        return item_id in self._offsets
+
+    def stamp(self, item_id: str) -> Tuple[Hashable, int]:
+        self._refresh()
+        if item_id not in self._offsets:
+            raise FileNotFoundError(item_id)
+        offset, length = self._offsets[item_id]
+        return (self._inode, offset), length
+
+    def load(self, item_id: str) -> dict:
+        self._refresh()
+        if item_id not in self._offsets:
+            raise FileNotFoundError(item_id)
+        offset, length = self._offsets[item_id]
+        return json.loads(self._mmap[offset : offset + length])
+
+    def save(self, item: dict) -> None:
+        record = f"+ {json.dumps(item['id'])}\t{json.dumps(item)}\n"
+        self._append(record.encode("utf8"))
+
+    def delete(self, item_id: str) -> None:
+        if not self.exists(item_id):
+            raise FileNotFoundError(item_id)
+        self._append(f"- {json.dumps(item_id)}\t\n".encode("utf8"))
+
+    def load_all(self) -> Iterator[dict]:
+        self._refresh()
+        # Read in segment order so the reads are sequential
+        for offset, length in sorted(self._offsets.values()):
+            yield json.loads(self._mmap[offset : offset + length])
+
+    def compact(self, force: bool = False) -> bool:
+        """
+        Rewrite the segment with only the latest record of each live item.
+        Unless forced, this is only done when enough of the segment is dead.
+        """
+        self._refresh()
+        live_bytes = self._scanned - self._dead_bytes
+        if not force and (
+            self._dead_bytes < COMPACT_MIN_DEAD_BYTES or self._dead_bytes < live_bytes
+        ):
+            return False
+
+        with self._lock():
+            self._refresh()
+            tmp_path = self.segment_path.with_name(f"{SEGMENT_FILENAME}.tmp")
+            with tmp_path.open("wb") as f:
+                for item_id, (offset, length) in sorted(
+                    self._offsets.items(), key=lambda entry: entry[1]
+                ):
+                    f.write(f"+ {json.dumps(item_id)}\t".encode("utf8"))
+                    f.write(self._mmap[offset : offset + length])
+                    f.write(b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.segment_path)
+            self._refresh()
+        return True
+
+    def destroy(self) -> None:
+        self._reset(None)
+        self.segment_path.unlink(missing_ok=True)
+
+
+class SqliteStorage(ItemStorage):
+    """
+    Items stored as rows in the source's index database, so that items and
+    their indexed fields are written in the same transactions. Item bodies are
+    kept in their own column with a hash, so that the other fields can be read
+    and updated and bodies compared without reading the body.
+    """
+
+    name = "sqlite"
+    separate_bodies = True
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS item_data (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT NOT NULL UNIQUE,
+        data TEXT NOT NULL,
+        body TEXT,
+        body_hash TEXT
+    )
+    """
+
+    def __init__(self, source_path: Path):
+        super().__init__(source_path)
+        self.index = ItemIndex(source_path / INDEX_FILENAME)
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            # Not executescript, which would commit an open batch
+            self.index.db.execute(self.SCHEMA)
+            self._db = self.index.db
+        return self._db
+
+    def open_index(self) -> ItemIndex:
+        return self.index
+
+    def batch(self):
+        return self.index.batch()
+
+    def ids(self) -> List[str]:
+        return [item_id for (item_id,) in self.db.execute("SELECT id FROM item_data")]
+
+    def exists(self, item_id: str) -> bool:
+        row = self.db.execute("SELECT 1 FROM item_data WHERE id = ?", (item_id,))
+        return row.fetchone() is not None
+
+    def stamp(self, item_id: str) -> Tuple[Hashable, int]:
+        # Replacing a row gives it a new seq, and seqs are never reused
+        cursor = self.db.execute(
+            "SELECT seq, length(data) + coalesce(length(body), 0)"
+            " FROM item_data WHERE id = ?",
+            (item_id,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise FileNotFoundError(item_id)
+        return row[0], row[1]
+
+    def load(self, item_id: str) -> dict:
+        cursor = self.db.execute(
+            "SELECT data, body FROM item_data WHERE id = ?", (item_id,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise FileNotFoundError(item_id)
+        return _join_body(*row)
+
+    def load_fields(self, item_id: str) -> dict:
+        cursor = self.db.execute("SELECT data FROM item_data WHERE id = ?", (item_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise FileNotFoundError(item_id)
+        return json.loads(row[0])
+
+    def save(self, item: dict) -> None:
+        # Only string bodies are kept apart, anything else stays in the fields
+        fields = dict(item)
+        body = fields.pop("body") if isinstance(item.get("body"), str) else None
+        self.db.execute(
+            "INSERT OR REPLACE INTO item_data (id, data, body, body_hash)"
+            " VALUES (?, ?, ?, ?)",
+            (item["id"], json.dumps(fields), body, _hash_body(body)),
+        )
+
+    def save_fields(self, item: dict) -> None:
+        # Replace the row rather than updating it so that it gets a new seq
+        fields = dict(item)
+        fields.pop("body", None)
+        cursor = self.db.execute(
+            "INSERT OR REPLACE INTO item_data (id, data, body, body_hash)"
+            " SELECT id, ?, body, body_hash FROM item_data WHERE id = ?",
+            (json.dumps(fields), item["id"]),
+        )
+        if cursor.rowcount == 0:
+            self.save(fields)
+
+    def body_changed(self, item_id: str, body: Optional[str]) -> bool:
+        if not isinstance(body, (str, type(None))):
+            return super().body_changed(item_id, body)
+        cursor = self.db.execute(
+            "SELECT body_hash FROM item_data WHERE id = ?", (item_id,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise FileNotFoundError(item_id)
+        return row[0] != _hash_body(body)
+
+    def delete(self, item_id: str) -> None:
+        cursor = self.db.execute("DELETE FROM item_data WHERE id = ?", (item_id,))
+        if cursor.rowcount == 0:
+            raise FileNotFoundError(item_id)
+
+    def load_all(self) -> Iterator[dict]:
+        for data, body in self.db.execute("SELECT data, body FROM item_data"):
+            yield _join_body(data, body)
+
+    def compact(self, force: bool = False) -> bool:
+        if not force:
+            return False
+        self.db.execute("VACUUM")
+        return True
+
+    def destroy(self) -> None:
+        self.db.execute("DROP TABLE item_data")
+        self._db = None
+
+
+def _join_body(data: str, body: Optional[str]) -> dict:
+    item = json.loads(data)
+    if body is not None:
+        item["body"] = body
+    return item
+
+
+def _hash_body(body: Optional[str]) -> Optional[str]:
+    if body is None:
+        return None
+    return hashlib.sha1(body.encode("utf8")).hexdigest()
+
+
+STORAGE_TYPES = {
+    storage.name: storage for storage in (FileStorage, SegmentStorage, SqliteStorage)
+}
+
+
+def open_storage(source_path: Path, storage_name: str) -> ItemStorage:
+    """
+    Get the item storage for a source directory by name.
+    """
+    if storage_name not in STORAGE_TYPES:
+        raise InvalidConfigException(f"No such storage {storage_name}")
+    return STORAGE_TYPES[storage_name](source_path)
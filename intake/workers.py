@@ -0,0 +1,336 @@
+from queue import Empty, Queue
+from subprocess import PIPE
+from threading import Event, Lock, Thread
+from typing import Dict, Hashable, List, Optional, Tuple
+import atexit
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+from intake.types import SourceUpdateException
+
+
+# How many persistent action workers may be running at once.
+DEFAULT_MAX_WORKERS = 8
+
+# How long a persistent action worker may go unused before it is stopped.
+DEFAULT_IDLE_TIMEOUT = 300
+
+# How long a stopped worker has to exit after its stdin is closed.
+STOP_GRACE_SECONDS = 1.0
+
+# How long an action's processes have to exit after SIGTERM before they are
+# killed with SIGKILL.
+KILL_GRACE_SECONDS = 5.0
+
+# How often a stopping action's processes are checked for having exited.
+STOP_POLL_SECONDS = 0.05
+
+# Resource limits for an action process, as (resource, (soft, hard)) pairs.
+Limits = Tuple[Tuple[int, Tuple[int, int]], ...]
+
+
+def apply_limits(pid: int, limits: Limits) -> None:
+    """
+    Apply resource limits to an action process as soon as it has started.
+    They are not set between fork and exec, since running Python code there
+    is not safe in a process with threads.
+    """
+    for which, (soft, hard) in limits:
+        try:
+            # Limits cannot be raised above the process's hard limit
+            _, max_hard = resource.prlimit(pid, which)
+            if max_hard != resource.RLIM_INFINITY:
+                soft, hard = min(soft, max_hard), min(hard, max_hard)
+            resource.prlimit(pid, which, (soft, hard))
+        except ProcessLookupError:
+            # The process already exited
+            return
+
+
+def signal_process_group(pid: int, sig: int) -> bool:
+    """
+    Send a signal to an action process and any children it started. Returns
+    False if there were no processes left to signal.
+    """
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def process_group_running(pid: int) -> bool:
+    """
+    Check whether an action process or any children it started are still
+    running. Processes that have exited but were not reaped are not counted.
+    """
+    if not signal_process_group(pid, 0):
+        return False
+    try:
+        entries = os.listdir("/proc")
+    except FileNotFoundError:
+        return True
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The fields after the command name are the state, parent, and group
+        state, _, group = stat.rsplit(")", 1)[1].split()[:3]
+        if int(group) == pid and state != "Z":
+            return True
+    return False
+
+
+class ActionWorker:
+    """
+    A long-running action process. Each request is written to its stdin as a
+    line, and it writes one line to its stdout in response.
+    """
+
+    def __init__(
+        self, spec: Tuple, command: List[str], env: dict, cwd: str, limits: Limits
+    ):
+        # The command, environment, directory, and limits that started this
+        # worker, so a worker started from an outdated config can be replaced
+        self.spec = spec
+        self.process = subprocess.Popen(
+            command,
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=PIPE,
+            cwd=cwd,
+            env=env,
+            # Start a new process group so the worker's children can be killed
+            start_new_session=True,
+        )
+        apply_limits(self.process.pid, limits)
+        self.last_used = time.monotonic()
+        # Requests in progress or waiting for this worker
+        self.users = 0
+        self.lock = Lock()
+        self.lines: Queue = Queue()
+        Thread(target=self._read_stdout, daemon=True).start()
+        Thread(target=self._read_stderr, daemon=True).start()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def _read_stdout(self) -> None:
+        for data in self.process.stdout:
+            self.lines.put(data)
+        # Wake up a waiting request if the worker exits
+        self.lines.put(None)
+
+    def _read_stderr(self) -> None:
+        for data in self.process.stderr:
+            print(f"[stderr] {data.decode('utf8').rstrip()}", file=sys.stderr)
+
+    def request(self, line: str, timeout: float, max_line_bytes: int) -> str:
+        """
+        Send a request line and wait for the response line. The caller must
+        hold the worker's lock. If the worker does not respond correctly, it
+        is stopped and SourceUpdateException is raised.
+        """
+        self.last_used = time.monotonic()
+        # Discard any output left over from an earlier request
+        while not self.lines.empty():
+            data = self.lines.get_nowait()
+            if data is None:
+                self.lines.put(None)
+                break
+            print(f"[stdout] (extra) {data.decode('utf8').rstrip()}", file=sys.stderr)
+        try:
+            self.process.stdin.write(line.rstrip("\n").encode("utf8") + b"\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            self.stop()
+            raise SourceUpdateException("worker exited")
+        try:
+            data = self.lines.get(timeout=timeout)
+        except Empty:
+            self.stop(graceful=False)
+            raise SourceUpdateException("worker timed out")
+        self.last_used = time.monotonic()
+        if data is None:
+            self.stop()
+            raise SourceUpdateException(
+                f"worker exited with code {self.process.returncode}"
+            )
+        if len(data) > max_line_bytes:
+            self.stop()
+            raise SourceUpdateException(
+                f"worker output a line longer than {max_line_bytes} bytes"
+            )
+        return data.decode("utf8")
+
+    def stop(self, graceful: bool = True) -> None:
+        """
+        Stop the worker and any children it started. If graceful, the worker
+        is first asked to exit by closing its stdin. Then any of them that are
+        still running are sent SIGTERM, and SIGKILL if they have not all
+        exited after a grace period.
+        """
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if graceful:
+            try:
+                self.process.wait(STOP_GRACE_SECONDS)
+            except subprocess.TimeoutExpired:
+                pass
+        pid = self.process.pid
+        if signal_process_group(pid, signal.SIGTERM):
+            deadline = time.monotonic() + KILL_GRACE_SECONDS
+            while time.monotonic() < deadline and process_group_running(pid):
+                # Reap the worker if it exited
+                self.process.poll()
+                time.sleep(STOP_POLL_SECONDS)
+            signal_process_group(pid, signal.SIGKILL)
+        self.process.wait()
+
+
+class WorkerPool:
+    """
+    The persistent action workers of this process, one per source action.
+    Requests to the same worker are handled one at a time. Workers that crash
+    are replaced on the next request, and workers that are idle for too long
+    are stopped.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ):
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self._workers: Dict[Hashable, ActionWorker] = {}
+        self._lock = Lock()
+        self._reaper: Optional[Thread] = None
+        self._stopped = Event()
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    def request(
+        self,
+        key: Hashable,
+        command: List[str],
+        env: dict,
+        cwd: str,
+        limits: Limits,
+        line: str,
+        timeout: float,
+        max_line_bytes: int,
+    ) -> Optional[str]:
+        """
+        Send a request line to the worker for a key, starting the worker if
+        needed, and return the response line. Returns None without running
+        anything if there are already max_workers busy workers.
+        """
+        spec = (tuple(command), tuple(sorted(env.items())), str(cwd), limits)
+        worker = self._acquire(key, spec, command, env, cwd, limits)
+        if worker is None:
+            return None
+        try:
+            with worker.lock:
+                if not worker.alive:
+                    raise SourceUpdateException(
+                        f"worker exited with code {worker.process.returncode}"
+                    )
+                return worker.request(line, timeout, max_line_bytes)
+        finally:
+            with self._lock:
+                worker.users -= 1
+                current = self._workers.get(key) is worker
+                if current and not worker.alive:
+                    del self._workers[key]
+                    current = False
+            # A worker replaced while it was in use is stopped by its last user
+            if not current and not worker.users:
+                worker.stop()
+
+    def _acquire(
+        self,
+        key: Hashable,
+        spec: Tuple,
+        command: List[str],
+        env: dict,
+        cwd: str,
+        limits: Limits,
+    ) -> Optional[ActionWorker]:
+        stopped = []
+        try:
+            with self._lock:
+                worker = self._workers.get(key)
+                if worker is not None and (worker.spec != spec or not worker.alive):
+                    del self._workers[key]
+                    if not worker.users:
+                        stopped.append(worker)
+                    worker = None
+                if worker is None:
+                    if len(self._workers) >= self.max_workers:
+                        # Make room by stopping the least recently used worker
+                        idle = [
+                            (w.last_used, k)
+                            for k, w in self._workers.items()
+                            if not w.users
+                        ]
+                        if not idle:
+                            return None
+                        stopped.append(self._workers.pop(min(idle)[1]))
+                    worker = ActionWorker(spec, command, env, cwd, limits)
+                    self._workers[key] = worker
+                    self._start_reaper()
+                worker.users += 1
+                return worker
+        finally:
+            for old in stopped:
+                old.stop()
+
+    def _start_reaper(self) -> None:
+        if self._reaper is None:
+            self._stopped = Event()
+            self._reaper = Thread(
+                target=self._reap_idle, args=(self._stopped,), daemon=True
+            )
+            self._reaper.start()
+
+    def _reap_idle(self, stopped: Event) -> None:
+        while not stopped.wait(min(self.idle_timeout, 60)):
+            now = time.monotonic()
+            with self._lock:
+                idle = [
+                    key
+                    for key, worker in self._workers.items()
+                    if not worker.users and now - worker.last_used > self.idle_timeout
+                ]
+                idle_workers = [self._workers.pop(key) for key in idle]
+            for worker in idle_workers:
+                worker.stop()
+
+    def shutdown(self) -> None:
+        """
+        Stop all workers.
+        """
+        with self._lock:
+            self._stopped.set()
+            self._reaper = None
+            stopped = list(self._workers.values())
+            self._workers.clear()
+        for worker in stopped:
+            worker.stop()
+
+
+WORKERS = WorkerPool()
+atexit.register(WORKERS.shutdown)
@@ -11,6 +11,9 @@ def clean_source(source_path: Path):
         if item.name.endswith(".item"):
             item.unlink()
     (source_path / "state").unlink(missing_ok=True)
+    for name in ("index.db", "index.db-wal", "index.db-shm"):
+        (source_path / name).unlink(missing_ok=True)
+    (source_path / "items.seg").unlink(missing_ok=True)
 
 
 @pytest.fixture
@@ -27,3 +30,5 @@ def using_source() -> Callable:
 
     for source_path in sources:
         clean_source(source_path)
+    for name in ("channels.db", "channels.db-wal", "channels.db-shm"):
+        (test_data / name).unlink(missing_ok=True)
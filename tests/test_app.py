@@ -0,0 +1,200 @@
+import json
+import re
+import sys
+import time
+
+from intake.app import app
+from intake.channels import ChannelIndex
+from intake.source import Item, LocalSource
+
+
+def feed_item_ids(response) -> list:
+    return re.findall(r'id="\w+-(\w+)">', response.data.decode("utf8"))
+
+
+def test_mass_deactivate(tmp_path):
+    for name in ("one", "two"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "intake.json").write_text(json.dumps({"action": {}}))
+        source = LocalSource(tmp_path, name)
+        for i in range(4):
+            tags = ["odd"] if i % 2 else []
+            item = Item.create(source, id=f"{name}{i}", time=i, tags=tags)
+            source.save_item(item)
+    (tmp_path / "channels.json").write_text(json.dumps({"both": ["one", "two"]}))
+    app.config["INTAKE_DATA"] = tmp_path
+    client = app.test_client()
+
+    # Requests without items or a filter are rejected
+    assert client.post("/mass-deactivate/", json={}).status_code == 400
+    response = client.post("/mass-deactivate/", json={"filter": {"tag": "odd"}})
+    assert response.status_code == 400
+
+    # Explicit items are grouped by source
+    items = [
+        {"source": "one", "itemid": "one0"},
+        {"source": "one", "itemid": "missing"},
+        {"source": "two", "itemid": "two0"},
+    ]
+    response = client.post("/mass-deactivate/", json={"items": items})
+    assert response.json == {"deactivated": 2, "sources": {"one": 1, "two": 1}}
+
+    # Filters select items from the index
+    item_filter = {"channel": "both", "tag": "odd", "time_before": 3}
+    response = client.post("/mass-deactivate/", json={"filter": item_filter})
+    assert response.json == {"deactivated": 2, "sources": {"one": 1, "two": 1}}
+    assert not LocalSource(tmp_path, "one").get_item("one1")["active"]
+    assert LocalSource(tmp_path, "one").get_item("one3")["active"]
+
+    response = client.post("/mass-deactivate/", json={"filter": {"source": "two"}})
+    assert response.json == {"deactivated": 2, "sources": {"two": 2}}
+    response = client.post("/mass-deactivate/", json={"filter": {"source": "nope"}})
+    assert response.status_code == 404
+
+    # Malformed requests are rejected
+    for params in (
+        {"items": [{"src": "one"}]},
+        {"items": [{"source": "one", "itemid": 1}]},
+        {"items": "one"},
+        {"filter": "channel"},
+        {"filter": {"channel": ["both"]}},
+    ):
+        assert client.post("/mass-deactivate/", json=params).status_code == 400
+
+
+def test_feed_etag(tmp_path):
+    (tmp_path / "one").mkdir()
+    (tmp_path / "one" / "intake.json").write_text(json.dumps({"action": {}}))
+    source = LocalSource(tmp_path, "one")
+    source.save_item(Item.create(source, id="first", title="First"))
+    app.config["INTAKE_DATA"] = tmp_path
+    client = app.test_client()
+
+    response = client.get("/source/one")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    # An unchanged feed is not rendered again
+    response = client.get("/source/one", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    # Different parameters or a changed source give a different page
+    response = client.get("/source/one?count=1", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    source.save_item(Item.create(source, id="second"))
+    response = client.get("/source/one", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_channel_index(tmp_path):
+    for name in ("one", "two", "three"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "intake.json").write_text(json.dumps({"action": {}}))
+        source = LocalSource(tmp_path, name)
+        for i in range(3):
+            source.save_item(Item.create(source, id=f"{name}{i}", time=i + 1))
+    channels_path = tmp_path / "channels.json"
+    channels_path.write_text(json.dumps({"some": ["one", "two"]}))
+    app.config["INTAKE_DATA"] = tmp_path
+    client = app.test_client()
+
+    # The channel is served from the channel index in feed order
+    response = client.get("/channel/some")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    ids = ["one0", "two0", "one1", "two1", "one2", "two2"]
+    assert feed_item_ids(response) == ids
+
+    # Deactivating an item removes it from the channel
+    client.post(
+        "/mass-deactivate/", json={"items": [{"source": "one", "itemid": "one0"}]}
+    )
+    response = client.get("/channel/some", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert feed_item_ids(response) == ids[1:]
+    assert client.get("/channel/some?hidden=true").status_code == 200
+
+    # Editing the channels only changes which sources are read
+    channels_path.write_text(json.dumps({"some": ["two", "three"]}))
+    response = client.get("/channel/some")
+    assert feed_item_ids(response) == [
+        "three0",
+        "two0",
+        "three1",
+        "two1",
+        "three2",
+        "two2",
+    ]
+
+    # A source index rebuilt behind the channel index's back is copied again
+    source = LocalSource(tmp_path, "three")
+    source.index.clear()
+    source.save_item(Item.create(source, id="three3", time=4))
+    response = client.get("/channel/some")
+    assert feed_item_ids(response) == ["two0", "two1", "two2", "three3"]
+
+
+def test_request_closes_indexes(tmp_path, monkeypatch):
+    (tmp_path / "one").mkdir()
+    (tmp_path / "one" / "intake.json").write_text(json.dumps({"action": {}}))
+    source = LocalSource(tmp_path, "one")
+    for i in range(3):
+        source.save_item(Item.create(source, id=f"one{i}"))
+    (tmp_path / "channels.json").write_text(json.dumps({"some": ["one"]}))
+    app.config["INTAKE_DATA"] = tmp_path
+    client = app.test_client()
+
+    closed = []
+    monkeypatch.setattr(LocalSource, "close", lambda self: closed.append(str(self)))
+    monkeypatch.setattr(ChannelIndex, "close", lambda self: closed.append("channels"))
+
+    # Each source is opened once per request and closed when it ends
+    assert client.get("/channel/some").status_code == 200
+    assert sorted(closed) == ["channels", "one"]
+
+
+APPEND_ACTION = """
+import json, sys, time
+item = json.loads(sys.stdin.readline())
+time.sleep(0.2)
+item["title"] = item.get("title", "") + "x"
+print(json.dumps(item))
+"""
+
+
+def wait_for_job(client, job: dict) -> dict:
+    deadline = time.time() + 10
+    while job["status"] not in ("done", "failed") and time.time() < deadline:
+        time.sleep(0.05)
+        job = client.get(job["url"]).json
+    return job
+
+
+def test_action_jobs(tmp_path):
+    (tmp_path / "one").mkdir()
+    action = {"exe": sys.executable, "args": ["-c", APPEND_ACTION]}
+    config = {"action": {"append": action, "fail": {"exe": "false"}}}
+    (tmp_path / "one" / "intake.json").write_text(json.dumps(config))
+    source = LocalSource(tmp_path, "one")
+    source.save_item(Item.create(source, id="a", action={"append": {}}))
+    app.config["INTAKE_DATA"] = tmp_path
+    client = app.test_client()
+
+    # Actions return a job immediately, and actions on the same item are run
+    # one after another
+    responses = [client.post("/action/one/a/append") for _ in range(2)]
+    assert [response.status_code for response in responses] == [202, 202]
+    jobs = [wait_for_job(client, response.json) for response in responses]
+    assert [job["status"] for job in jobs] == ["done", "done"]
+    assert jobs[1]["item"]["title"] == "xx"
+    assert 'id="one-a"' in jobs[1]["html"]
+    assert LocalSource(tmp_path, "one").get_item("a")["title"] == "xx"
+
+    # Failures are reported by the job
+    job = wait_for_job(client, client.post("/action/one/a/fail").json)
+    assert job["status"] == "failed"
+    assert "error" in job
+    assert client.post("/action/one/missing/append").status_code == 404
+    assert client.get("/job/nope").status_code == 404
@@ -0,0 +1,37 @@
+import json
+import sys
+
+from intake.cli import cmd_update
+from intake.source import LocalSource
+
+
+def make_source(data_path, name, script):
+    (data_path / name).mkdir()
+    fetch = {"exe": sys.executable, "args": ["-c", script]}
+    config = {"action": {"fetch": fetch}}
+    (data_path / name / "intake.json").write_text(json.dumps(config))
+
+
+# Fetches one item named after the source
+FETCH_NAME = "import json, os; print(json.dumps({'id': os.path.basename(os.getcwd())}))"
+
+
+def test_update_all(tmp_path, capsys):
+    for name in ("one", "two"):
+        make_source(tmp_path, name, FETCH_NAME)
+    make_source(tmp_path, "broken", "import sys; sys.exit(1)")
+
+    for jobs in ("1", "3"):
+        # A failing source doesn't stop the others, but the run fails
+        assert cmd_update(["--data", str(tmp_path), "--all", "--jobs", jobs]) == 1
+        assert LocalSource(tmp_path, "one").get_item_ids() == ["one"]
+        assert LocalSource(tmp_path, "two").get_item_ids() == ["two"]
+
+        # Each source's result is summarized
+        lines = [line.split() for line in capsys.readouterr().err.splitlines()]
+        assert ["broken", "failed"] in lines
+        assert [line[:2] for line in lines if line[:1] == ["one"]] == [["one", "ok"]]
+        assert [line[:2] for line in lines if line[:1] == ["two"]] == [["two", "ok"]]
+        assert ["2", "succeeded,", "1", "failed"] in lines
+
+    assert cmd_update(["--data", str(tmp_path), "--source", "one", "two"]) == 0
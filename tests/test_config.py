@@ -0,0 +1,27 @@
+import json
+
+from intake.config import ConfigCache
+
+
+def test_config_cache(tmp_path):
+    config_path = tmp_path / "channels.json"
+    cache = ConfigCache(max_age=60)
+    assert cache.read_json(config_path) is None
+    assert cache.list_sources(tmp_path) == []
+
+    # Cached values are used until they are invalidated or too old
+    config_path.write_text(json.dumps({"a": ["one"]}))
+    assert cache.read_json(config_path) is None
+    cache.invalidate(config_path)
+    assert cache.read_json(config_path) == {"a": ["one"]}
+
+    # Changes are seen when the file is checked again
+    cache.max_age = 0
+    config_path.write_text(json.dumps({"b": ["two"]}))
+    assert cache.read_json(config_path) == {"b": ["two"]}
+
+    # A source directory whose config is written just after it is created
+    (tmp_path / "one").mkdir()
+    assert cache.list_sources(tmp_path) == []
+    (tmp_path / "one" / "intake.json").write_text("{}")
+    assert cache.list_sources(tmp_path) == ["one"]
@@ -0,0 +1,51 @@
+from datetime import datetime
+import json
+
+import pytest
+
+from intake.crontab import CronSchedule, get_desired_crons
+from intake.types import InvalidConfigException
+
+
+def test_cron_schedule():
+    now = datetime(2024, 1, 10, 12, 30, 15)
+
+    # Matching times are strictly after the given time
+    assert CronSchedule("* * * * *").next_after(now) == datetime(2024, 1, 10, 12, 31)
+    assert CronSchedule("30 12 * * *").next_after(now) == datetime(2024, 1, 11, 12, 30)
+
+    # Steps, ranges, and lists are supported
+    assert CronSchedule("*/20 * * * *").next_after(now) == datetime(2024, 1, 10, 12, 40)
+    assert CronSchedule("0 9-17/4 * * *").next_after(now) == datetime(2024, 1, 10, 13)
+    assert CronSchedule("5,10 0 * * *").next_after(now) == datetime(2024, 1, 11, 0, 5)
+
+    # 2024-01-10 is a Wednesday, and 0 and 7 are both Sunday
+    assert CronSchedule("0 0 * * 0").next_after(now) == datetime(2024, 1, 14)
+    assert CronSchedule("0 0 * * 7").next_after(now) == datetime(2024, 1, 14)
+
+    # When both day fields are restricted, either one can match
+    assert CronSchedule("0 0 20 * 5").next_after(now) == datetime(2024, 1, 12)
+
+    # Rare schedules are found
+    assert CronSchedule("0 0 29 2 *").next_after(now) == datetime(2024, 2, 29)
+
+    with pytest.raises(InvalidConfigException):
+        CronSchedule("* * *")
+    with pytest.raises(InvalidConfigException):
+        CronSchedule("60 * * * *")
+    with pytest.raises(InvalidConfigException):
+        CronSchedule("0 0 31 2 *").next_after(now)
+
+
+def test_desired_crons(tmp_path, monkeypatch):
+    (tmp_path / "src").mkdir()
+    config = {"action": {}, "cron": "0 * * * *"}
+    (tmp_path / "src" / "intake.json").write_text(json.dumps(config))
+    (tmp_path / "channels.json").write_text("{}")
+    assert list(get_desired_crons(tmp_path)) == [
+        "0 * * * *  . /etc/profile; intake update -s src"
+    ]
+
+    # With crontab management off, the managed entries are removed
+    monkeypatch.setenv("INTAKE_CRONTAB", "0")
+    assert list(get_desired_crons(tmp_path)) == []
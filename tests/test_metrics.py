@@ -0,0 +1,54 @@
+from intake.metrics import Counter, Histogram, Registry, read_textfile
+
+
+def test_metrics_render():
+    registry = Registry()
+    reads = Counter("reads_total", "Reads", ["storage"], registry=registry)
+    latency = Histogram(
+        "latency_seconds", "Latency", ["stage"], buckets=[0.1, 1], registry=registry
+    )
+    reads.inc(storage="files")
+    reads.inc(2, storage="files")
+    latency.observe(0.05, stage="load")
+    latency.observe(0.5, stage="load")
+    latency.observe(5, stage="load")
+
+    lines = registry.render().splitlines()
+    assert "# TYPE reads_total counter" in lines
+    assert 'reads_total{storage="files"} 3' in lines
+    buckets = [line for line in lines if line.startswith("latency_seconds_bucket")]
+    assert buckets == [
+        'latency_seconds_bucket{stage="load",le="0.1"} 1',
+        'latency_seconds_bucket{stage="load",le="1"} 2',
+        'latency_seconds_bucket{stage="load",le="+Inf"} 3',
+    ]
+    assert 'latency_seconds_count{stage="load"} 3' in lines
+    assert 'latency_seconds_sum{stage="load"} 5.55' in lines
+
+
+def test_metrics_textfile(tmp_path):
+    textfile = tmp_path / "metrics.prom"
+
+    # Two processes adding to the same textfile
+    registries = [Registry(), Registry()]
+    counters = [
+        Counter("items_total", "Items", ["source"], registry=registry)
+        for registry in registries
+    ]
+    counters[0].inc(2, source='a "quoted" name')
+    registries[0].write_textfile(textfile)
+    counters[1].inc(3, source='a "quoted" name')
+    registries[1].write_textfile(textfile)
+
+    # Only changes since the last write are added
+    counters[0].inc(1, source='a "quoted" name')
+    registries[0].write_textfile(textfile)
+    key = ("items_total", (("source", 'a "quoted" name'),))
+    assert read_textfile(textfile) == {key: 6}
+
+    # The web process adds the textfile to its own metrics
+    web = Registry()
+    Counter("items_total", "Items", ["source"], registry=web).inc(source="b")
+    lines = web.render(read_textfile(textfile)).splitlines()
+    assert 'items_total{source="a \\"quoted\\" name"} 6' in lines
+    assert 'items_total{source="b"} 1' in lines
@@ -0,0 +1,45 @@
+from threading import Thread
+import json
+import time
+
+from intake.scheduler import Scheduler
+from intake.source import LocalSource, fetch_items, update_items
+
+
+def test_reload_skips_bad_sources(tmp_path):
+    crons = {"good": "* * * * *", "never": "0 0 31 2 *", "invalid": "nope"}
+    for name, spec in crons.items():
+        (tmp_path / name).mkdir()
+        config = {"action": {}, "cron": spec}
+        (tmp_path / name / "intake.json").write_text(json.dumps(config))
+    (tmp_path / "channels.json").write_text("{}")
+
+    # Sources that can't be scheduled don't stop the others from being scheduled
+    scheduler = Scheduler(tmp_path)
+    scheduler.reload()
+    assert list(scheduler.schedules) == ["good"]
+    assert [entry[2] for entry in scheduler.queue] == ["good"]
+
+
+def test_update_queues_reap(tmp_path):
+    (tmp_path / "src").mkdir()
+    source = LocalSource(tmp_path, "src")
+    item = json.dumps({"id": "a", "ttd": 2})
+    source.save_config({"action": {"fetch": {"exe": "echo", "args": [item]}}})
+    update_items(source, fetch_items(source))
+    source.save_config({"action": {"fetch": {"exe": "true"}}})
+
+    scheduler = Scheduler(tmp_path)
+    thread = Thread(target=scheduler.run)
+    thread.start()
+    try:
+        # An update that leaves an item to expire queues a reap, which runs
+        # when the item expires instead of waiting for the next reload
+        scheduler.start_update("src")
+        deadline = time.monotonic() + 5
+        while source.get_item_ids() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert source.get_item_ids() == []
+    finally:
+        scheduler.stop()
+        thread.join()
@@ -1,6 +1,30 @@
+import asyncio
 import json
+import sys
+import time
 
-from intake.source import fetch_items, update_items, LocalSource
+import pytest
+
+from intake.cache import ItemCache
+from intake.channels import ChannelIndex
+from intake.index import ItemIndex
+from intake.metrics import UPDATE_ITEMS, UPDATE_PHASE_DURATION
+from intake.source import (
+    execute_action,
+    FetchStatus,
+    fetch_items,
+    fetch_items_async,
+    Item,
+    ItemUpdate,
+    iter_fetch_items,
+    iter_fetch_items_async,
+    reap_items,
+    update_items,
+    update_items_async,
+    LocalSource,
+)
+from intake.types import InvalidConfigException, SourceUpdateException
+from intake.workers import WORKERS
 
 
 def test_default_source(using_source):
@@ -8,6 +32,7 @@ def test_default_source(using_source):
     fetch = fetch_items(source)
     assert len(fetch) == 0
 
+
 def test_basic_lifecycle(using_source):
     source: LocalSource = using_source("test_inbox")
     state = {"inbox": [{"id": "first"}]}
@@ -61,3 +86,652 @@ def test_basic_lifecycle(using_source):
     items = list(source.get_all_items())
     assert len(items) == 1
     assert items[0]["id"] == "second"
+
+
+def test_item_index(using_source):
+    source: LocalSource = using_source("test_inbox")
+    state = {"inbox": [{"id": "first", "time": 2}, {"id": "second", "time": 1}]}
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+
+    # The index tracks the items written by the update
+    indexed = {item["id"]: item for item in source.get_indexed_items()}
+    assert sorted(indexed) == ["first", "second"]
+    assert indexed["first"]["time"] == 2
+    assert indexed["first"]["active"] == True
+    assert "title" not in indexed["first"]
+
+    # Saving and deleting items keeps the index current
+    first = source.get_item("first")
+    first["active"] = False
+    source.save_item(first)
+    source.delete_item("second")
+    indexed = {item["id"]: item for item in source.get_indexed_items()}
+    assert sorted(indexed) == ["first"]
+    assert indexed["first"]["active"] == False
+
+    # A missing index is rebuilt from the item files
+    source.index.close()
+    source.index.index_path.unlink()
+    source = LocalSource(source.data_path, source.source_name)
+    assert [item["id"] for item in source.get_indexed_items()] == ["first"]
+
+
+def test_index_reads_during_batch(tmp_path):
+    writer = ItemIndex(tmp_path / "index.db")
+    writer.put({"id": "a", "created": 1, "active": True})
+    with writer.batch():
+        writer.put({"id": "b", "created": 2, "active": True})
+
+        # Opening and reading the index does not wait for the batch
+        reader = ItemIndex(tmp_path / "index.db")
+        reader.db.execute("PRAGMA busy_timeout = 0")
+        assert reader.count() == 1
+    assert reader.count() == 2
+
+
+def test_source_batches_in_parallel(tmp_path):
+    sources = {}
+    for name in ("one", "two"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "intake.json").write_text(json.dumps({"action": {}}))
+        sources[name] = LocalSource(tmp_path, name)
+    one, two = sources["one"], sources["two"]
+    one.save_item(Item.create(one, id="a"))
+
+    # A batch only locks the channel index while it writes its changes, so
+    # writes to other sources don't wait for it
+    with one.batch():
+        one.save_item(Item.create(one, id="b"))
+        two.channel_index.db.execute("PRAGMA busy_timeout = 0")
+        two.save_item(Item.create(two, id="c"))
+        one.delete_item("a")
+    rows = ChannelIndex(tmp_path).db.execute("SELECT source, id FROM channel_items")
+    assert sorted(rows) == [("one", "b"), ("two", "c")]
+    assert one.channel_index.synced_generation("one") == one.index.generation()
+
+
+def test_item_update_counts(tmp_path):
+    (tmp_path / "src").mkdir()
+    source = LocalSource(tmp_path, "src")
+    source.save_config({"action": {}})
+    update_items(source, [Item.create(source, id=i) for i in ("a", "b", "c")])
+    c = source.get_item("c")
+    c["active"] = False
+    source.save_item(c)
+    phases_before = UPDATE_PHASE_DURATION.collect()
+    items_before = UPDATE_ITEMS.collect()
+
+    # Fetched items are sorted into new, changed, and unchanged items, and
+    # inactive items that were not fetched are deleted
+    update = ItemUpdate(source)
+    update.add(
+        [
+            Item.create(source, id="a"),
+            Item.create(source, id="b", title="B"),
+            Item.create(source, id="d"),
+        ]
+    )
+    assert update.new_ids == {"d"}
+    assert update.upd_ids == {"a", "b"}
+    assert update.changed_ids == {"b"}
+    update.finish()
+    assert sorted(source.get_item_ids()) == ["a", "b", "d"]
+
+    def increases(metric, before, suffix):
+        return {
+            dict(labels).popitem()[1]: value - before.get((name, labels), 0)
+            for (name, labels), value in metric.collect().items()
+            if name.endswith(suffix) and value != before.get((name, labels), 0)
+        }
+
+    # Each phase is observed once, and each kind of change is counted
+    phases = increases(UPDATE_PHASE_DURATION, phases_before, "_count")
+    assert phases == {"scan": 1, "new": 1, "update": 1, "delete": 1}
+    items = increases(UPDATE_ITEMS, items_before, "_total")
+    assert items == {"new": 1, "changed": 1, "deleted": 1}
+
+
+def test_reap_items(using_source):
+    source: LocalSource = using_source("test_inbox")
+    state = {"inbox": [{"id": "a", "ttd": 100}, {"id": "b", "tts": 100}, {"id": "c"}]}
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+    b = source.get_item("b")
+    assert source.index.next_tts(0) == b["created"] + 100
+
+    # Items still in the fetch are never reaped
+    state = {"inbox": [{"id": "b", "tts": 100}]}
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+    assert sorted(source.get_item_ids()) == ["a", "b", "c"]
+    assert reap_items(source) == 0
+    b["active"] = False
+    source.save_item(b)
+    assert source.index.next_tts(0) is None
+    assert reap_items(source) == 0
+
+    # Items that were not in the latest fetch are reaped once they expire
+    a = source.get_item("a")
+    assert source.index.next_removal() == a["created"] + 100
+    a["created"] -= 200
+    source.save_item(a)
+    c = source.get_item("c")
+    c["active"] = False
+    source.save_item(c)
+    assert reap_items(source) == 2
+    assert sorted(source.get_item_ids()) == ["b"]
+    assert source.index.next_removal() is None
+
+
+CONDITIONAL_FETCH = """
+import json, os
+state = json.load(open(os.environ["STATE_PATH"]))
+if os.environ.get("LAST_FETCH") == str(state["version"]):
+    print(json.dumps({"not_modified": True}))
+else:
+    for item in state["items"]:
+        print(json.dumps(item))
+    if state["version"]:
+        print(json.dumps({"cursor": str(state["version"])}))
+"""
+
+
+def test_conditional_fetch(tmp_path):
+    (tmp_path / "src").mkdir()
+    source = LocalSource(tmp_path, "src")
+    fetch = {"exe": sys.executable, "args": ["-c", CONDITIONAL_FETCH]}
+    source.save_config({"action": {"fetch": fetch}})
+
+    def update(state):
+        source.get_state_path().write_text(json.dumps(state))
+        status = FetchStatus()
+        update_items(source, iter_fetch_items(source, status=status), status)
+        return status
+
+    # The cursor of a completed fetch is passed to the next fetch
+    state = {"version": 1, "items": [{"id": "a", "ttd": 100}, {"id": "b"}]}
+    assert not update(state).not_modified
+    assert source.get_fetch_cursor() == "1"
+    state = {"version": 2, "items": [{"id": "b"}]}
+    assert not update(state).not_modified
+    assert source.get_fetch_cursor() == "2"
+
+    # A fetch that reports not modified only deletes items that have expired
+    # since they were left out of a fetch
+    a = source.get_item("a")
+    a["created"] -= 200
+    source.save_item(a)
+    state["items"] = []
+    assert update(state).not_modified
+    assert source.get_item_ids() == ["b"]
+    assert source.get_fetch_cursor() == "2"
+
+    # A modified feed is updated as usual
+    state = {"version": 3, "items": [{"id": "c"}]}
+    assert not update(state).not_modified
+    assert sorted(source.get_item_ids()) == ["b", "c"]
+    assert source.get_fetch_cursor() == "3"
+
+    # Callers that don't get the status are not given the cursor
+    assert [item["id"] for item in fetch_items(source)] == ["c"]
+
+    # A fetch without a cursor clears it, and a fetch can't be both
+    state = {"version": 4, "items": [{"id": "d"}, {"cursor": None}]}
+    with pytest.raises(SourceUpdateException, match="cursor must be a string"):
+        update(state)
+    state = {"version": None, "items": [{"id": "d"}]}
+    update(state)
+    assert source.get_fetch_cursor() is None
+    state["items"].append({"not_modified": True})
+    with pytest.raises(SourceUpdateException, match="not modified"):
+        update(state)
+
+
+PRINT_LINES = """
+import json, os
+for line in json.load(open(os.environ["STATE_PATH"])):
+    print(json.dumps(line))
+"""
+
+
+def test_delta_fetch(tmp_path, capsys):
+    (tmp_path / "src").mkdir()
+    source = LocalSource(tmp_path, "src")
+    fetch = {"exe": sys.executable, "args": ["-c", PRINT_LINES]}
+    source.save_config({"action": {"fetch": fetch}})
+
+    def update(lines):
+        source.get_state_path().write_text(json.dumps(lines))
+        status = FetchStatus()
+        update_items(source, iter_fetch_items(source, status=status), status)
+
+    update([{"id": "a"}, {"id": "b", "ttd": 100}, {"id": "c"}, {"id": "d"}])
+    c = source.get_item("c")
+    c["active"] = False
+    source.save_item(c)
+    capsys.readouterr()
+
+    # A delta only changes the items it mentions, without scanning the source
+    update(
+        [
+            {"delta": True},
+            {"id": "a", "title": "A"},
+            {"id": "b", "deleted": True},
+            {"id": "c", "deleted": True},
+            {"id": "e"},
+        ]
+    )
+    assert "prior items" not in capsys.readouterr().err
+    assert sorted(source.get_item_ids()) == ["a", "b", "d", "e"]
+    assert source.get_item("a")["title"] == "A"
+
+    # Deleted items that are kept are reaped once they expire
+    b = source.get_item("b")
+    b["created"] -= 200
+    source.save_item(b)
+    update([{"delta": True}])
+    assert sorted(source.get_item_ids()) == ["a", "d", "e"]
+
+    with pytest.raises(SourceUpdateException, match="delta after items"):
+        update([{"id": "a"}, {"delta": True}])
+
+    # A partial fetch can't be used by a caller that expects the full feed
+    source.get_state_path().write_text(json.dumps([{"delta": True}, {"id": "f"}]))
+    with pytest.raises(SourceUpdateException, match="full feed"):
+        update_items(source, fetch_items(source))
+    assert sorted(source.get_item_ids()) == ["a", "d", "e"]
+
+
+def test_sorted_items(using_source):
+    source: LocalSource = using_source("test_inbox")
+    state = {
+        "inbox": [
+            {"id": "b", "time": 1},
+            {"id": "a", "time": 1},
+            {"id": "later", "time": 2, "tts": 3600},
+            {"id": "c"},
+        ]
+    }
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+
+    # Items are sorted by time, then id, and items before tts are hidden
+    all_ids = [item["id"] for item in source.get_sorted_items(show_hidden=True)]
+    assert all_ids == ["a", "b", "later", "c"]
+    assert source.count_items(show_hidden=True) == 4
+    shown_ids = [item["id"] for item in source.get_sorted_items(show_hidden=False)]
+    assert shown_ids == ["a", "b", "c"]
+    assert source.count_items(show_hidden=False) == 3
+
+
+def test_lazy_item(using_source):
+    source: LocalSource = using_source("test_inbox")
+    state = {
+        "inbox": [{"id": "first", "title": "one", "body": "<p>hi</p>", "tags": ["a"]}]
+    }
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+
+    # Indexed items read other fields from storage, but don't keep the body
+    # until it is accessed
+    (item,) = source.get_indexed_items()
+    assert not hasattr(item, "title")
+    assert item["title"] == "one"
+    assert item.get("author") is None
+    assert not hasattr(item, "body")
+    assert "body" in item
+    assert item["body"] == "<p>hi</p>"
+
+    # Changes to a lazy item are saved along with the fields it didn't read
+    (item,) = source.get_indexed_items()
+    item["active"] = False
+    source.save_item(item)
+    assert source.get_item("first").to_dict() == {
+        "id": "first",
+        "created": item["created"],
+        "active": False,
+        "title": "one",
+        "body": "<p>hi</p>",
+        "tags": ["a"],
+    }
+
+
+def test_item_cache(using_source):
+    source: LocalSource = using_source("test_inbox")
+    state = {"inbox": [{"id": "first", "title": "one"}]}
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+
+    cache = ItemCache()
+    cached = LocalSource(source.data_path, source.source_name, item_cache=cache)
+    assert cached.get_item("first")["title"] == "one"
+    assert len(cache) == 1
+
+    # Changes made without the cache invalidate the cached item
+    item = source.get_item("first")
+    item["title"] = "two"
+    source.save_item(item)
+    assert cached.get_item("first")["title"] == "two"
+
+    # Unsaved changes to an item do not leak into the cache
+    item = cached.get_item("first")
+    item["title"] = "three"
+    assert cached.get_item("first")["title"] == "two"
+
+    # The cache evicts items to stay under its size limit
+    cache.max_bytes = 1
+    cache.put("other", None, {}, 1)
+    assert len(cache) == 1
+    assert cache.size == 1
+
+
+def test_fetch_limits(using_source):
+    source: LocalSource = using_source("test_limits")
+    state = {"inbox": [{"id": "first"}, {"id": "second"}]}
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+
+    # A fetch that returns too many items fails
+    state = {"inbox": [{"id": "third"}, {"id": "fourth"}, {"id": "fifth"}]}
+    source.get_state_path().write_text(json.dumps(state))
+    with pytest.raises(SourceUpdateException):
+        fetch_items(source)
+
+    # A failed fetch does not remove items
+    first = source.get_item("first")
+    first["active"] = False
+    source.save_item(first)
+    with pytest.raises(SourceUpdateException):
+        update_items(source, iter_fetch_items(source))
+    assert source.item_exists("first")
+
+    # A fetch that outputs a line that is too long fails
+    state = {"inbox": [{"id": "x" * 100}]}
+    source.get_state_path().write_text(json.dumps(state))
+    with pytest.raises(SourceUpdateException):
+        fetch_items(source)
+
+
+WORKER_SCRIPT = """
+import json, os, sys
+for line in sys.stdin:
+    item = json.loads(line)
+    if item.get("title") == "crash":
+        sys.exit(1)
+    item["title"] = f"{os.getpid()} {os.environ['GREETING']}"
+    print(json.dumps(item), flush=True)
+"""
+
+
+def test_persistent_action(tmp_path):
+    (tmp_path / "src").mkdir()
+    source = LocalSource(tmp_path, "src")
+    action = {"exe": sys.executable, "args": ["-c", WORKER_SCRIPT], "persistent": True}
+    config = {"action": {"act": action}, "env": {"GREETING": "hi"}}
+    source.save_config(config)
+    source.save_item(Item.create(source, id="a"))
+
+    # The same worker handles each request
+    pid, greeting = execute_action(source, "a", "act")["title"].split()
+    assert greeting == "hi"
+    assert execute_action(source, "a", "act")["title"].split()[0] == pid
+
+    # A crashed worker is replaced on the next request
+    item = source.get_item("a")
+    item["title"] = "crash"
+    source.save_item(item)
+    with pytest.raises(SourceUpdateException):
+        execute_action(source, "a", "act")
+    item["title"] = ""
+    source.save_item(item)
+    new_pid = execute_action(source, "a", "act")["title"].split()[0]
+    assert new_pid != pid
+
+    # A config change starts a new worker
+    config["env"]["GREETING"] = "hello"
+    source.save_config(config)
+    pid, greeting = execute_action(source, "a", "act")["title"].split()
+    assert pid != new_pid
+    assert greeting == "hello"
+    WORKERS.shutdown()
+
+
+SLOW_FETCH = """
+import json, os, time
+name = os.path.basename(os.getcwd())
+for i in range(3):
+    print(json.dumps({"id": f"{name}{i}"}), flush=True)
+    time.sleep(0.2)
+"""
+
+
+def test_update_async_concurrently(tmp_path, capsys):
+    sources = []
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        source = LocalSource(tmp_path, name)
+        fetch = {"exe": sys.executable, "args": ["-c", SLOW_FETCH]}
+        source.save_config({"action": {"fetch": fetch}})
+        sources.append(source)
+
+    async def update_all():
+        await asyncio.gather(
+            *[
+                update_items_async(source, iter_fetch_items_async(source))
+                for source in sources
+            ]
+        )
+
+    # Both fetches are read at once, so their output is interleaved
+    start = time.monotonic()
+    asyncio.run(update_all())
+    assert time.monotonic() - start < 1.2
+    fetched = [
+        line.split('"')[3]
+        for line in capsys.readouterr().err.splitlines()
+        if line.startswith("[stdout]")
+    ]
+    assert sorted(fetched) == ["a0", "a1", "a2", "b0", "b1", "b2"]
+    assert fetched.index("b0") < fetched.index("a2")
+    assert fetched.index("a0") < fetched.index("b2")
+    assert sorted(sources[0].get_item_ids()) == ["a0", "a1", "a2"]
+    assert sorted(sources[1].get_item_ids()) == ["b0", "b1", "b2"]
+
+
+def process_running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    # An exited process that has not been reaped is a zombie
+    return state != "Z"
+
+
+def test_hung_fetch_killed(tmp_path):
+    (tmp_path / "src").mkdir()
+    source = LocalSource(tmp_path, "src")
+    script = "sleep 60 & echo $! > child.pid; wait"
+    source.save_config({"action": {"fetch": {"exe": "sh", "args": ["-c", script]}}})
+
+    # A fetch that times out is killed along with the processes it started
+    with pytest.raises(SourceUpdateException, match="timed out"):
+        asyncio.run(fetch_items_async(source, timeout=0.5))
+    child_pid = int((tmp_path / "src" / "child.pid").read_text())
+    assert not process_running(child_pid)
+
+
+def test_fetch_exits_with_children_running(tmp_path):
+    (tmp_path / "src").mkdir()
+    source = LocalSource(tmp_path, "src")
+    script = 'echo \'{"id": "a"}\'; sleep 30 & echo $! > child.pid'
+    source.save_config({"action": {"fetch": {"exe": "sh", "args": ["-c", script]}}})
+
+    # A fetch is done when it exits, even if a child it left running still
+    # holds its output open
+    start = time.monotonic()
+    items = asyncio.run(fetch_items_async(source, timeout=20))
+    assert time.monotonic() - start < 5
+    assert [item["id"] for item in items] == ["a"]
+    child_pid = int((tmp_path / "src" / "child.pid").read_text())
+    assert not process_running(child_pid)
+
+
+def test_lingering_children_terminated(tmp_path):
+    (tmp_path / "src").mkdir()
+    source = LocalSource(tmp_path, "src")
+    child = "trap 'echo > terminated; exit' TERM; sleep 30 & wait"
+    script = f'sh -c "{child}" > /dev/null 2>&1 & sleep 0.2; echo \'{{"id": "a"}}\''
+    source.save_config({"action": {"fetch": {"exe": "sh", "args": ["-c", script]}}})
+
+    # Children still running after a fetch exits are asked to exit with SIGTERM
+    start = time.monotonic()
+    assert [item["id"] for item in fetch_items(source)] == ["a"]
+    assert time.monotonic() - start < 5
+    assert (tmp_path / "src" / "terminated").exists()
+
+
+def test_action_limits(tmp_path):
+    (tmp_path / "src").mkdir()
+    source = LocalSource(tmp_path, "src")
+
+    # A fetch that runs past its timeout is stopped along with its children
+    fetch = {"exe": "sh", "args": ["-c", "sleep 30 & sleep 30"], "timeout": 0.5}
+    source.save_config({"action": {"fetch": fetch}})
+    start = time.monotonic()
+    with pytest.raises(SourceUpdateException, match="timed out"):
+        fetch_items(source)
+    assert time.monotonic() - start < 5
+
+    # A fetch that uses too much memory fails
+    script = "x = bytearray(512 * 1024 * 1024)"
+    fetch = {"exe": sys.executable, "args": ["-c", script]}
+    source.save_config({"action": {"fetch": fetch}})
+    assert fetch_items(source) == []
+    fetch["memory_limit"] = 256 * 1024 * 1024
+    source.save_config({"action": {"fetch": fetch}})
+    with pytest.raises(SourceUpdateException):
+        fetch_items(source)
+
+    # Limits that aren't positive integers are invalid
+    for key in ("cpu_limit", "max_items", "max_line_bytes", "max_output_bytes"):
+        source.save_config({"action": {"fetch": {**fetch, key: "lots"}}})
+        with pytest.raises(InvalidConfigException, match=key):
+            fetch_items(source)
+
+
+def test_update_unchanged(using_source):
+    source: LocalSource = using_source("test_inbox")
+    state = {"inbox": [{"id": "first"}, {"id": "second", "title": "two"}]}
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+    first_mtime = source.get_item_path("first").stat().st_mtime_ns
+    second_mtime = source.get_item_path("second").stat().st_mtime_ns
+
+    # Only the item whose fields changed is rewritten
+    state = {"inbox": [{"id": "first"}, {"id": "second", "title": "2"}]}
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+    assert source.get_item_path("first").stat().st_mtime_ns == first_mtime
+    assert source.get_item_path("second").stat().st_mtime_ns != second_mtime
+    assert source.get_item("second")["title"] == "2"
+
+
+def test_segment_storage(using_source):
+    source: LocalSource = using_source("test_segment")
+    state = {"inbox": [{"id": "first"}, {"id": "second"}]}
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+
+    # Items are stored in the segment instead of item files
+    assert not source.get_item_path("first").exists()
+    assert source.item_exists("first")
+    assert sorted(source.get_item_ids()) == ["first", "second"]
+    assert source.get_item("first").get("active") == True
+
+    # Saved and deleted items are visible to other instances of the source
+    first = source.get_item("first")
+    first["active"] = False
+    source.save_item(first)
+    source.delete_item("second")
+    other = LocalSource(source.data_path, source.source_name)
+    assert other.get_item("first").get("active") == False
+    assert not other.item_exists("second")
+    assert [item["id"] for item in other.get_all_items()] == ["first"]
+
+    # Compaction drops dead records without changing the items
+    size = source.storage.segment_path.stat().st_size
+    assert source.compact(force=True)
+    assert source.storage.segment_path.stat().st_size < size
+    assert other.get_item("first").get("active") == False
+    assert not other.item_exists("second")
+
+    # The usual update semantics apply
+    state = {"inbox": []}
+    source.get_state_path().write_text(json.dumps(state))
+    update_items(source, fetch_items(source))
+    assert not other.item_exists("first")
+
+
+def test_convert_storage(tmp_path):
+    source_path = tmp_path / "source"
+    source_path.mkdir()
+    (source_path / "intake.json").write_text(json.dumps({"action": {}}))
+    source = LocalSource(tmp_path, "source")
+    for item_id in ("first", "second"):
+        source.save_item(Item.create(source, id=item_id, title=item_id.upper()))
+
+    assert source.convert_storage("segment") == 2
+    assert source.get_config()["storage"] == "segment"
+    assert not source.get_item_path("first").exists()
+    source = LocalSource(tmp_path, "source")
+    assert source.get_item("first")["title"] == "FIRST"
+
+    assert source.convert_storage("sqlite") == 2
+    assert not (source_path / "items.seg").exists()
+    source = LocalSource(tmp_path, "source")
+    assert source.get_item("second")["title"] == "SECOND"
+    first = source.get_item("first")
+    first["active"] = False
+    source.save_item(first)
+    source.delete_item("second")
+    assert [item["id"] for item in source.get_all_items()] == ["first"]
+    assert source.count_items(show_hidden=True) == 1
+    assert source.count_items(show_hidden=False) == 0
+    source.save_item(Item.create(source, id="second", title="SECOND"))
+
+    assert source.convert_storage("files") == 2
+    assert source.get_item("first")["active"] == False
+    assert source.get_item_path("second").exists()
+    source = LocalSource(tmp_path, "source")
+    assert sorted(source.get_item_ids()) == ["first", "second"]
+
+
+def test_separate_bodies(tmp_path):
+    source_path = tmp_path / "source"
+    source_path.mkdir()
+    config = {"action": {}, "storage": "sqlite"}
+    (source_path / "intake.json").write_text(json.dumps(config))
+    source = LocalSource(tmp_path, "source")
+    update_items(source, [Item.create(source, id="first", title="1", body="one")])
+
+    # Items can be updated, compared, and saved without reading their bodies
+    def fail_load(item_id):
+        raise AssertionError("body read")
+
+    load = source.storage.load
+    source.storage.load = fail_load
+    update_items(source, [Item.create(source, id="first", title="2", body="one")])
+    item = source.get_item("first", body=False)
+    assert item["title"] == "2"
+    item["active"] = False
+    source.save_item(item)
+    source.storage.load = load
+
+    item = source.get_item("first")
+    assert (item["title"], item["body"], item["active"]) == ("2", "one", False)
+
+    # A changed body is still noticed
+    update_items(source, [Item.create(source, id="first", body="uno")])
+    assert source.get_item("first")["body"] == "uno"